@@ -1,63 +1,232 @@
 #!/usr/bin/env python3
 import os
 import sys
+import csv
 import json
+import re
+import hashlib
+import importlib.util
+import shutil
+import argparse
 import uuid
-import random
+import secrets
+import base64
 import string
+import socket
+import bisect
+import functools
+import struct
 import subprocess
-import datetime
+import shlex
+import fcntl
+import threading
+import atexit
+import builtins
+import tempfile
+import time
 import urllib.parse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# 证书目录、默认密钥类型、有效期及提前续期的天数
+CERT_DIR = Path("/etc/sing-box/cert")
+CERT_KEY_TYPE = "ecdsa"
+CERT_VALID_DAYS = 3650
+CERT_RENEW_BEFORE = 30
+
+# Hysteria2带宽: 出入口限速配置文件、网卡信息目录、带宽余量比例、无法检测时的默认值 (Mbps)
+BANDWIDTH_FILE = Path("/etc/sing-box/bandwidth.json")
+SYS_CLASS_NET = Path("/sys/class/net")
+HY2_BANDWIDTH_HEADROOM = 0.9
+HY2_DEFAULT_MBPS = 1000
+# 命名的带宽档位 (上行Mbps, 下行Mbps)
+HY2_BANDWIDTH_TIERS = {
+    "100m": (90, 90),
+    "1g": (900, 900),
+    "10g": (9000, 9000),
+}
+
+# 内核网络参数配置: 持久化文件、回滚用的原始值备份及各调优方案
+SYSCTL_CONF_FILE = "/etc/sysctl.d/99-sing-box.conf"
+SYSCTL_BACKUP_FILE = "/var/lib/sing-box-manager/sysctl_backup.json"
+SYSCTL_PROFILES = {
+    # BBR + fq，UDP缓冲区按quic-go建议的7.5MB
+    "default": {
+        "net.core.default_qdisc": "fq",
+        "net.ipv4.tcp_congestion_control": "bbr",
+        "net.core.rmem_max": "7500000",
+        "net.core.wmem_max": "7500000",
+    },
+    # 高带宽高延迟线路，放大TCP/UDP缓冲区和接收队列
+    "throughput": {
+        "net.core.default_qdisc": "fq",
+        "net.ipv4.tcp_congestion_control": "bbr",
+        "net.core.rmem_max": "33554432",
+        "net.core.wmem_max": "33554432",
+        "net.ipv4.tcp_rmem": "4096 131072 33554432",
+        "net.ipv4.tcp_wmem": "4096 65536 33554432",
+        "net.ipv4.udp_rmem_min": "16384",
+        "net.ipv4.udp_wmem_min": "16384",
+        "net.core.netdev_max_backlog": "16384",
+        "net.ipv4.tcp_fastopen": "3",
+        "net.ipv4.tcp_mtu_probing": "1",
+    },
+}
+
+# 服务器IP缓存文件 (override字段可手动指定IP)
+SERVER_IP_FILE = Path("/etc/sing-box/server_ip.json")
+# 服务器IP缓存有效期 (秒)
+SERVER_IP_TTL = 6 * 3600
+# 公网IP查询失败时，回退结果的进程内缓存有效期 (秒)
+SERVER_IP_FALLBACK_TTL = 60
+# 进程内IP缓存
+_server_ip_cache = {"ip": None, "time": 0, "ttl": SERVER_IP_TTL}
+
+# 依赖检查记录及有效期 (秒)
+DEPS_STAMP_FILE = Path("/var/cache/sing-box-manager/deps.json")
+DEPS_STAMP_TTL = 7 * 24 * 3600
+
+# sing-box版本缓存
+SINGBOX_VERSION_CACHE_FILE = Path("/var/cache/sing-box-manager/singbox_version.json")
+_singbox_version_cache = {}
+
+# X25519曲线参数
+X25519_P = 2 ** 255 - 19
+X25519_A24 = 121665
+X25519_BASE_POINT = (9).to_bytes(32, "little")
+
+# 由本工具添加的防火墙规则记录
+FIREWALL_STATE_FILE = Path("/etc/sing-box/firewall.json")
+
+# 订阅服务默认监听地址、配置检查间隔及空闲连接超时 (秒)
+SUBSCRIPTION_HOST = "0.0.0.0"
+SUBSCRIPTION_PORT = 2096
+SUBSCRIPTION_REFRESH_INTERVAL = 5
+SUBSCRIPTION_IDLE_TIMEOUT = 30
+
+# 用户数据库
+USER_DB_FILE = Path("/etc/sing-box/users.db")
+# 配置修改锁文件、等待锁的超时 (秒) 及并发冲突时的重试次数
+CONFIG_LOCK_FILE = Path("/etc/sing-box/.config.lock")
+CONFIG_LOCK_TIMEOUT = 30
+CONFIG_EDIT_RETRIES = 5
+
+# 分片设置文件及每个分片的虚拟节点数
+SHARD_FILE = Path("/etc/sing-box/shards.json")
+SHARD_VIRTUAL_NODES = 64
+
+# 操作跟踪的环境变量 (1表示只输出汇总，其他值作为Chrome trace文件路径)
+TRACE_ENV = "SINGBOX_MANAGER_TRACE"
+# 需要跟踪的模块函数及其类别 (子进程和open()另行包装)
+TRACED_FUNCTIONS = {
+    "save_json": "file",
+    "query_v2ray_stats": "network",
+    "get_local_ip": "network",
+}
+
+# 多服务器管理: 主机列表文件、SSH连接复用目录及保持时间 (秒)、并发数、远程脚本路径
+FLEET_FILE = Path("/etc/sing-box/fleet.json")
+FLEET_CONTROL_DIR = Path.home() / ".ssh" / "sing-box-manager"
+FLEET_CONTROL_PERSIST = 300
+FLEET_MAX_WORKERS = 8
+FLEET_REMOTE_SCRIPT = "/usr/local/sbin/sing-box-manager"
+FLEET_COMMAND_TIMEOUT = 600
+
+# 基准测试默认用户规模、结果文件及回退判定阈值 (耗时超过基线的倍数)
+BENCH_SIZES = (10, 1000, 100000)
+BENCH_BASELINE_FILE = Path("bench_baseline.json")
+BENCH_REGRESSION_THRESHOLD = 1.5
+BENCH_QRCODE_SAMPLE = 8
+
+# 用户列表每页显示数量
+LIST_PAGE_SIZE = 20
+
+# 链接中无需百分号编码的字符
+URL_SAFE_RE = re.compile(r"[A-Za-z0-9_.~-]*\Z")
+
+# 流量统计接口地址、数据目录及原始记录保留时间 (秒)
+TRAFFIC_API_ADDRESS = "127.0.0.1:10085"
+TRAFFIC_DIR = Path("/var/lib/sing-box-manager/traffic")
+TRAFFIC_RAW_RETENTION = 2 * 86400
+TRAFFIC_RECORD = struct.Struct("<IIQQ")
+
+# 健康检查的超时 (秒)、最大并发探测数及QUIC探测使用的保留版本号 (服务端会回复版本协商包)
+HEALTH_TIMEOUT = 3
+HEALTH_CONCURRENCY = 256
+QUIC_PROBE_VERSION = 0x1A2A3A4A
+
+# 日志分析状态文件 (journald游标及按时间段汇总的统计)、汇总粒度、保留时间及首次读取范围 (秒)
+LOG_STATS_FILE = Path("/var/lib/sing-box-manager/log_stats.json")
+LOG_BUCKET_SECONDS = 300
+LOG_STATS_RETENTION = 7 * 86400
+LOG_INITIAL_WINDOW = 86400
+# sing-box日志行: 级别 [连接ID 耗时] inbound/类型[标签]: [用户名] 内容
+LOG_LINE_RE = re.compile(r"\b(?P<level>TRACE|DEBUG|INFO|WARN|ERROR|FATAL|PANIC)\b.*?"
+                         r"inbound/(?P<type>[\w-]+)\[(?P<tag>[^\]]*)\]: (?:\[(?P<user>[^\]]+)\] )?(?P<text>.*)")
+ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+# 二维码图片缓存目录及上限
+QRCODE_DIR = "/tmp/qrcode"
+QRCODE_CACHE_MAX_FILES = 5000
+QRCODE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# 读取依赖检查记录
+def load_deps_state():
+    try:
+        with open(DEPS_STAMP_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+# 依赖检查记录是否仍然有效 (只做文件状态检查，不启动子进程)
+def deps_state_valid(state):
+    if not state or time.time() - state.get("time", 0) > DEPS_STAMP_TTL:
+        return False
+    if state.get("python") != sys.executable:
+        return False
+    for path in list(state.get("tools", {}).values()) + list(state.get("libs", {}).values()):
+        if not path or not os.path.exists(path):
+            return False
+    return True
+
+# 安装系统包
+def install_system_package(package, state):
+    if os.path.exists("/etc/debian_version"):
+        # 仅在确实需要安装时才更新软件源
+        if not state.get("apt_updated"):
+            subprocess.run(["apt", "update"], check=True)
+            state["apt_updated"] = True
+        subprocess.run(["apt", "install", "-y", package], check=True)
+    elif os.path.exists("/etc/redhat-release"):
+        subprocess.run(["yum", "install", "-y", package], check=True)
 
 # 检查和安装依赖
-def check_dependencies():
+def check_dependencies(force=False):
+    if not force and deps_state_valid(load_deps_state()):
+        return True
+    
     print("检查依赖...")
+    install_state = {}
     
     # 安装必要的系统包
     try:
-        # 先检查系统类型
-        if os.path.exists("/etc/debian_version"):
-            # Debian/Ubuntu系统
-            subprocess.run(["apt", "update"], check=True)
-            
+        if os.path.exists("/etc/debian_version") or os.path.exists("/etc/redhat-release"):
             # 检查pip
-            try:
-                subprocess.run(["which", "pip3"], check=True, stdout=subprocess.DEVNULL)
-            except subprocess.CalledProcessError:
-                print("安装pip3...")
-                subprocess.run(["apt", "install", "-y", "python3-pip"], check=True)
-                
-            # 检查UFW
-            try:
-                subprocess.run(["which", "ufw"], check=True, stdout=subprocess.DEVNULL)
-            except subprocess.CalledProcessError:
-                print("安装UFW...")
-                subprocess.run(["apt", "install", "-y", "ufw"], check=True)
-                
-        elif os.path.exists("/etc/redhat-release"):
-            # CentOS/RHEL系统
-            try:
-                subprocess.run(["which", "pip3"], check=True, stdout=subprocess.DEVNULL)
-            except subprocess.CalledProcessError:
+            if not shutil.which("pip3"):
                 print("安装pip3...")
-                subprocess.run(["yum", "install", "-y", "python3-pip"], check=True)
+                install_system_package("python3-pip", install_state)
                 
             # 检查UFW
-            try:
-                subprocess.run(["which", "ufw"], check=True, stdout=subprocess.DEVNULL)
-            except subprocess.CalledProcessError:
+            if not shutil.which("ufw"):
                 print("安装UFW...")
-                subprocess.run(["yum", "install", "-y", "ufw"], check=True)
+                install_system_package("ufw", install_state)
     except Exception as e:
         print(f"安装系统依赖失败: {e}")
     
-    # 检查Python库
+    # 检查Python库 (只查找模块，不导入)
     missing_libs = []
     
-    try:
-        import qrcode
-    except ImportError:
+    if importlib.util.find_spec("qrcode") is None:
         missing_libs.append("qrcode[pil]")
     
     if missing_libs:
@@ -69,15 +238,81 @@ def check_dependencies():
             print(f"安装{', '.join(missing_libs)}库失败: {e}")
             print(f"请手动安装: pip install --break-system-packages {' '.join(missing_libs)}")
             return False
+        importlib.invalidate_caches()
+    
+    # 记录检查结果，下次启动时直接复用 (有工具缺失时不记录，下次启动重新检查)
+    state = {
+        "time": time.time(),
+        "python": sys.executable,
+        "tools": {name: shutil.which(name) for name in ("pip3", "ufw") if shutil.which(name)},
+        "libs": {}
+    }
+    missing_tools = [name for name in ("pip3", "ufw") if name not in state["tools"]]
+    if missing_tools:
+        print(f"未找到 {', '.join(missing_tools)}，下次启动时将重新检查依赖")
+        return True
+    spec = importlib.util.find_spec("qrcode")
+    if spec and spec.origin:
+        state["libs"]["qrcode"] = spec.origin
+    try:
+        save_json(DEPS_STAMP_FILE, state)
+    except OSError as e:
+        print(f"保存依赖检查记录失败: {e}")
     
     return True
 
+# 获取sing-box程序的缓存键 (路径、修改时间、inode)
+def singbox_binary_key():
+    path = shutil.which("sing-box")
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.realpath(path), st.st_mtime_ns, st.st_ino]
+
+# 清除sing-box版本缓存 (安装、更新或卸载后调用)
+def invalidate_singbox_version_cache():
+    _singbox_version_cache.clear()
+    try:
+        SINGBOX_VERSION_CACHE_FILE.unlink()
+    except OSError:
+        pass
+
 # 检查是否已安装sing-box
 def check_singbox():
+    key = singbox_binary_key()
+    if key is None:
+        return False, None
+    
+    # 进程内缓存
+    if _singbox_version_cache.get("key") == key:
+        version = _singbox_version_cache["version"]
+        print(f"已检测到sing-box，当前版本: {version}")
+        return True, version
+    
+    # 磁盘缓存
+    try:
+        with open(SINGBOX_VERSION_CACHE_FILE, 'r') as f:
+            cached = json.load(f)
+        if cached.get("key") == key and cached.get("version"):
+            _singbox_version_cache.update(cached)
+            print(f"已检测到sing-box，当前版本: {cached['version']}")
+            return True, cached["version"]
+    except Exception:
+        pass
+    
     try:
-        result = subprocess.run(["sing-box", "version"], capture_output=True, text=True)
+        result = subprocess.run([key[0], "version"], capture_output=True, text=True)
         if result.returncode == 0:
             version = result.stdout.strip()
+            cached = {"key": key, "version": version}
+            _singbox_version_cache.update(cached)
+            try:
+                save_json(SINGBOX_VERSION_CACHE_FILE, cached)
+            except OSError:
+                pass
             print(f"已检测到sing-box，当前版本: {version}")
             return True, version
         return False, None
@@ -100,6 +335,7 @@ def install_singbox(version_type="stable", specific_version=None):
         
     try:
         subprocess.run(cmd, shell=True, check=True)
+        invalidate_singbox_version_cache()
         print("sing-box安装成功!")
         return True
     except subprocess.CalledProcessError as e:
@@ -117,12 +353,13 @@ def uninstall_singbox():
     
     try:
         # 停止服务
+        services = singbox_services()
         print("停止sing-box服务...")
-        subprocess.run(["systemctl", "stop", "sing-box"], check=False)
+        subprocess.run(["systemctl", "stop"] + services, check=False)
         
         # 禁用服务
         print("禁用sing-box服务...")
-        subprocess.run(["systemctl", "disable", "sing-box"], check=False)
+        subprocess.run(["systemctl", "disable"] + services, check=False)
         
         # 删除sing-box可执行文件
         print("删除sing-box程序...")
@@ -138,6 +375,7 @@ def uninstall_singbox():
         
         # 重新加载系统服务
         subprocess.run(["systemctl", "daemon-reload"], check=False)
+        invalidate_singbox_version_cache()
         
         print("sing-box已成功卸载")
         return True
@@ -146,92 +384,522 @@ def uninstall_singbox():
         return False
 
 # 启动服务
-def start_service():
+def start_service(service="sing-box"):
     try:
-        subprocess.run(["systemctl", "start", "sing-box"], check=True)
-        print("sing-box服务已启动")
+        subprocess.run(["systemctl", "start", service], check=True)
+        print(f"{service}服务已启动")
     except subprocess.CalledProcessError as e:
         print(f"启动失败: {e}")
 
 # 重启服务
-def restart_service():
+def restart_service(service="sing-box"):
+    start = time.monotonic()
     try:
-        subprocess.run(["systemctl", "restart", "sing-box"], check=True)
-        print("sing-box服务已重启")
+        subprocess.run(["systemctl", "restart", service], check=True)
+        print(f"{service}服务已重启 (耗时 {(time.monotonic() - start) * 1000:.0f} ms)")
     except subprocess.CalledProcessError as e:
         print(f"重启失败: {e}")
 
+# 读取配置文件
+def load_config(config_file="/etc/sing-box/config.json"):
+    config_file = Path(config_file)
+    if not config_file.exists():
+        print("配置文件不存在")
+        return None
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
+# 配置校验失败 (临时文件未通过校验，原文件保持不变)
+class ConfigInvalidError(Exception):
+    pass
+
+# 原子写入一组文件 [(路径, 内容, 权限)]: 先全部写入临时文件并fsync，再依次重命名覆盖
+# validate校验临时文件失败时抛出ConfigInvalidError，此时不替换任何文件
+def write_files_atomic(files, validate=None):
+    pending = []
+    try:
+        for path, content, mode in files:
+            path = Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+            pending.append((tmp_path, path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, mode)
+            if validate and not validate(tmp_path):
+                raise ConfigInvalidError(f"{path} 未通过校验，保留原配置")
+        for tmp_path, path in pending:
+            os.replace(tmp_path, path)
+    except BaseException:
+        for tmp_path, _ in pending:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        raise
+    
+    # 确保重命名落盘
+    for parent in {Path(path).parent for path, _, _ in files}:
+        dir_fd = os.open(parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+# 原子写入JSON文件 (先写临时文件并fsync，再重命名覆盖)
+# 内容与磁盘上一致时跳过写入并返回False；validate校验临时文件失败时抛出ConfigInvalidError
+def save_json(path, data, validate=None):
+    path = Path(path)
+    content = json.dumps(data, indent=4).encode("utf-8")
+    try:
+        if path.read_bytes() == content:
+            return False
+        mode = path.stat().st_mode & 0o777
+    except OSError:
+        mode = 0o644
+    write_files_atomic([(path, content, mode)], validate)
+    return True
+
+# 计算规范化配置的哈希
+def config_hash(config):
+    data = json.dumps(config, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+# 校验配置文件
+def check_config(config_file="/etc/sing-box/config.json"):
+    try:
+        result = subprocess.run(["sing-box", "check", "-c", str(config_file)], capture_output=True, text=True)
+    except FileNotFoundError:
+        print("警告: 未找到sing-box，跳过配置校验")
+        return True
+    if result.returncode != 0:
+        print(f"配置校验失败: {(result.stderr or result.stdout).strip()}")
+        return False
+    return True
+
+# 检查服务是否正在运行
+def service_is_active(service="sing-box"):
+    try:
+        result = subprocess.run(["systemctl", "is-active", "--quiet", service])
+        return result.returncode == 0
+    except FileNotFoundError:
+        return False
+
+# 检查服务是否支持reload
+def service_can_reload(service="sing-box"):
+    try:
+        result = subprocess.run(["systemctl", "show", "-p", "CanReload", "--value", service],
+                              capture_output=True, text=True)
+        return result.stdout.strip() == "yes"
+    except FileNotFoundError:
+        return False
+
+# 热重载服务 (配置未变化时跳过，不中断已建立的连接)
+def reload_service(old_hash=None, new_hash=None, config_file="/etc/sing-box/config.json", service="sing-box"):
+    if old_hash is not None and old_hash == new_hash:
+        print("配置未变化，跳过重载")
+        return True
+    
+    if not check_config(config_file):
+        print("配置有误，未重载服务")
+        return False
+    
+    # 服务未运行时直接启动
+    if not service_is_active(service):
+        restart_service(service)
+        return True
+    
+    start = time.monotonic()
+    try:
+        if service_can_reload(service):
+            subprocess.run(["systemctl", "reload", service], check=True)
+        else:
+            subprocess.run(["systemctl", "kill", "-s", "HUP", service], check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"重载失败: {e}，尝试重启服务...")
+        restart_service(service)
+        return True
+    
+    print(f"{service}服务已重载 (耗时 {(time.monotonic() - start) * 1000:.0f} ms)")
+    return True
+
 # 停止服务
-def stop_service():
+def stop_service(service="sing-box"):
     try:
-        subprocess.run(["systemctl", "stop", "sing-box"], check=True)
-        print("sing-box服务已停止")
+        subprocess.run(["systemctl", "stop", service], check=True)
+        print(f"{service}服务已停止")
     except subprocess.CalledProcessError as e:
         print(f"停止失败: {e}")
 
 # 生成随机字符串
 def random_string(length=8):
-    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(secrets.choice(alphabet) for _ in range(length))
 
-# 获取服务器IP
-def get_server_ip():
+# 读取服务器IP缓存文件
+def load_server_ip_state():
+    if SERVER_IP_FILE.exists():
+        try:
+            with open(SERVER_IP_FILE, 'r') as f:
+                return json.load(f)
+        except:
+            pass
+    return {}
+
+# 保存服务器IP缓存文件
+def save_server_ip_state(state):
+    try:
+        save_json(SERVER_IP_FILE, state)
+    except Exception as e:
+        print(f"保存服务器IP缓存失败: {e}")
+
+# 从本地网卡获取出口IP (不发送数据包，无需联网)
+def get_local_ip():
+    for family, target in ((socket.AF_INET, "8.8.8.8"), (socket.AF_INET6, "2001:4860:4860::8888")):
+        try:
+            with socket.socket(family, socket.SOCK_DGRAM) as s:
+                s.connect((target, 53))
+                ip = s.getsockname()[0]
+                if ip and not ip.startswith("127.") and ip != "::1":
+                    return ip
+        except OSError:
+            continue
+    return None
+
+# 通过公网接口查询服务器IP
+def query_public_ip(timeout=5):
     try:
-        result = subprocess.run(["curl", "-s", "https://api.ipify.org"], capture_output=True, text=True)
-        return result.stdout.strip()
-    except:
+        result = subprocess.run(["curl", "-s", "--max-time", str(timeout), "https://api.ipify.org"],
+                              capture_output=True, text=True)
+        ip = result.stdout.strip()
+        if result.returncode == 0 and ip:
+            return ip
+    except Exception:
+        pass
+    return None
+
+# 获取服务器IP
+# 顺序: 手动指定 -> 进程内缓存 -> 未过期的文件缓存 -> 公网查询 -> 过期缓存 -> 本地网卡
+def get_server_ip(refresh=False):
+    now = time.time()
+    if not refresh and _server_ip_cache["ip"] and now - _server_ip_cache["time"] < _server_ip_cache["ttl"]:
+        return _server_ip_cache["ip"]
+    
+    state = load_server_ip_state()
+    ip = state.get("override")
+    if not ip and not refresh and state.get("ip") and now - state.get("time", 0) < SERVER_IP_TTL:
+        ip = state["ip"]
+    
+    ttl = SERVER_IP_TTL
+    if not ip:
+        ip = query_public_ip()
+        if ip:
+            state["ip"] = ip
+            state["time"] = now
+            save_server_ip_state(state)
+        else:
+            # 查询失败时的过期IP或本机IP只短暂缓存，尽快重新查询
+            ip = state.get("ip") or get_local_ip()
+            ttl = SERVER_IP_FALLBACK_TTL
+    
+    if not ip:
         return "请手动填写服务器IP"
+    
+    _server_ip_cache.update(ip=ip, time=now, ttl=ttl)
+    return ip
+
+# 设置服务器IP
+def set_server_ip():
+    state = load_server_ip_state()
+    print("\n=== 服务器IP设置 ===")
+    print(f"手动指定IP: {state.get('override') or '未设置'}")
+    print(f"缓存IP: {state.get('ip') or '无'}")
+    print(f"本地网卡IP: {get_local_ip() or '无'}")
+    print("1. 手动指定IP")
+    print("2. 清除手动指定")
+    print("3. 重新检测公网IP")
+    print("0. 返回")
+    
+    choice = input("\n请选择操作 [0-3]: ").strip()
+    
+    if choice == "1":
+        ip = input("请输入服务器IP或域名: ").strip()
+        if not ip:
+            print("IP不能为空")
+            return
+        state["override"] = ip
+        save_server_ip_state(state)
+        print(f"服务器IP已设置为: {ip}")
+    elif choice == "2":
+        state.pop("override", None)
+        save_server_ip_state(state)
+        print("已清除手动指定的IP")
+    elif choice == "3":
+        state.pop("override", None)
+        save_server_ip_state(state)
+        print(f"当前服务器IP: {get_server_ip(refresh=True)}")
+    elif choice != "0":
+        print("无效选择")
+    _server_ip_cache["ip"] = None
+
+# X25519标量乘法 (RFC 7748 Montgomery ladder)
+def x25519(scalar, u_point):
+    p = X25519_P
+    k = bytearray(scalar)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    k = int.from_bytes(k, "little")
+    x1 = int.from_bytes(u_point, "little") & ((1 << 255) - 1)
+    
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        k_t = (k >> t) & 1
+        if swap ^ k_t:
+            x2, x3 = x3, x2
+            z2, z3 = z3, z2
+        swap = k_t
+        
+        a = (x2 + z2) % p
+        aa = a * a % p
+        b = (x2 - z2) % p
+        bb = b * b % p
+        e = (aa - bb) % p
+        c = (x3 + z3) % p
+        d = (x3 - z3) % p
+        da = d * a % p
+        cb = c * b % p
+        x3 = (da + cb) * (da + cb) % p
+        z3 = x1 * (da - cb) * (da - cb) % p
+        x2 = aa * bb % p
+        z2 = e * (aa + X25519_A24 * e) % p
+    
+    if swap:
+        x2, z2 = x3, z3
+    return (x2 * pow(z2, p - 2, p) % p).to_bytes(32, "little")
+
+# 编码Reality密钥 (与sing-box相同的无填充URL安全base64)
+def encode_reality_key(key):
+    return base64.urlsafe_b64encode(key).rstrip(b"=").decode("ascii")
+
+# 批量生成Reality密钥对 (进程内生成，不依赖sing-box程序)
+def generate_reality_keypairs(count):
+    pairs = []
+    for _ in range(count):
+        private_key = bytearray(secrets.token_bytes(32))
+        private_key[0] &= 248
+        private_key[31] &= 127
+        private_key[31] |= 64
+        public_key = x25519(bytes(private_key), X25519_BASE_POINT)
+        pairs.append((encode_reality_key(bytes(private_key)), encode_reality_key(public_key)))
+    return pairs
 
 # 生成Reality密钥对
 def generate_reality_keypair():
-    try:
-        result = subprocess.run(["sing-box", "generate", "reality-keypair"], 
-                              capture_output=True, text=True, check=True)
-        lines = result.stdout.strip().split('\n')
-        private_key = lines[0].split(': ')[1]
-        public_key = lines[1].split(': ')[1]
-        return private_key, public_key
-    except Exception as e:
-        print(f"生成Reality密钥对失败: {e}")
-        # 如果失败，返回空字符串
-        return "", ""
+    return generate_reality_keypairs(1)[0]
+
+# 批量生成short_id
+def generate_short_ids(count, length=8):
+    return [secrets.token_hex(length // 2) for _ in range(count)]
 
 # 生成short_id
 def generate_short_id():
+    return generate_short_ids(1)[0]
+
+# 支持的证书密钥类型 (ecdsa: P-256, ed25519, rsa: 2048位)
+CERT_KEY_TYPES = ("ecdsa", "ed25519", "rsa")
+
+# 生成自签证书，返回 (证书PEM, 私钥PEM, 到期时间戳)
+# 安装了cryptography时在进程内生成，否则调用openssl
+def generate_certificate(domain, key_type=CERT_KEY_TYPE, days=CERT_VALID_DAYS):
+    if importlib.util.find_spec("cryptography"):
+        import datetime
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+        
+        if key_type == "ed25519":
+            key = ed25519.Ed25519PrivateKey.generate()
+        elif key_type == "rsa":
+            key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        else:
+            key = ec.generate_private_key(ec.SECP256R1())
+        
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain)])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        not_after = now + datetime.timedelta(days=days)
+        cert = (x509.CertificateBuilder()
+                .subject_name(name)
+                .issuer_name(name)
+                .public_key(key.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now - datetime.timedelta(minutes=5))
+                .not_valid_after(not_after)
+                .add_extension(x509.SubjectAlternativeName([x509.DNSName(domain)]), critical=False)
+                .sign(key, None if key_type == "ed25519" else hashes.SHA256()))
+        key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+        return cert.public_bytes(serialization.Encoding.PEM), key_pem, int(not_after.timestamp())
+    
+    newkey = {"ecdsa": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"],
+              "ed25519": ["-newkey", "ed25519"],
+              "rsa": ["-newkey", "rsa:2048"]}[key_type]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_file, key_file = f"{tmp_dir}/cert.pem", f"{tmp_dir}/key.pem"
+        subprocess.run(["openssl", "req", "-x509"] + newkey +
+                       ["-keyout", key_file, "-out", cert_file, "-days", str(days), "-nodes",
+                        "-subj", f"/CN={domain}", "-addext", f"subjectAltName=DNS:{domain}"],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(cert_file, 'rb') as f:
+            cert_pem = f.read()
+        with open(key_file, 'rb') as f:
+            key_pem = f.read()
+    return cert_pem, key_pem, int(time.time()) + days * 86400
+
+# 证书的SHA-256指纹 (即Hysteria2客户端pinSHA256使用的值)
+def certificate_fingerprint(cert_pem):
+    body = re.search(rb"-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----", cert_pem, re.S)
+    der = base64.b64decode(b"".join(body.group(1).split())) if body else b""
+    return ":".join(f"{byte:02X}" for byte in hashlib.sha256(der).digest())
+
+# 读取证书信息: 优先使用cert.json，记录缺失或与证书不符时从证书本身读取到期时间
+def load_certificate_info(cert_dir=CERT_DIR):
+    import ssl
+    cert_dir = Path(cert_dir)
     try:
-        result = subprocess.run(["openssl", "rand", "-hex", "4"], 
-                              capture_output=True, text=True, check=True)
-        return result.stdout.strip()
-    except Exception as e:
-        print(f"生成short_id失败: {e}")
-        # 如果失败，使用随机字符串
-        return random_string(4)
+        with open(cert_dir / "cert.pem", 'rb') as f:
+            cert_pem = f.read()
+    except OSError:
+        return None
+    fingerprint = certificate_fingerprint(cert_pem)
+    
+    try:
+        with open(cert_dir / "cert.json", 'r') as f:
+            info = json.load(f)
+        if info.get("sha256") == fingerprint:
+            return info
+    except (OSError, ValueError):
+        pass
+    
+    info = {"domain": None, "key_type": "unknown", "not_after": None, "sha256": fingerprint}
+    try:
+        result = subprocess.run(["openssl", "x509", "-noout", "-enddate", "-subject", "-in", str(cert_dir / "cert.pem")],
+                                capture_output=True, text=True)
+        for line in result.stdout.splitlines():
+            if line.startswith("notAfter="):
+                info["not_after"] = int(ssl.cert_time_to_seconds(line.split("=", 1)[1].strip()))
+            elif "CN" in line:
+                info["domain"] = line.rsplit("=", 1)[-1].strip()
+    except (OSError, ValueError):
+        pass
+    
+    # 记录解析结果，之后不必再调用openssl
+    if info["not_after"]:
+        try:
+            save_json(cert_dir / "cert.json", info)
+        except OSError:
+            pass
+    return info
+
+# 写入证书和私钥 (私钥权限600) 并记录证书信息
+def write_certificate(cert_dir, domain, key_type, cert_pem, key_pem, not_after):
+    cert_dir = Path(cert_dir)
+    # 私钥和证书都落盘后才替换，避免两者不匹配
+    write_files_atomic([(cert_dir / "key.pem", key_pem, 0o600), (cert_dir / "cert.pem", cert_pem, 0o644)])
+    info = {"domain": domain, "key_type": key_type, "created_at": int(time.time()),
+            "not_after": not_after, "sha256": certificate_fingerprint(cert_pem)}
+    save_json(cert_dir / "cert.json", info)
+    return info
 
-# 创建自签证书
-def create_self_signed_cert(domain="www.speedtest.net", cert_dir="/etc/sing-box/cert"):
+# 创建自签证书 (已存在时直接使用)
+def create_self_signed_cert(domain="www.speedtest.net", cert_dir=CERT_DIR, key_type=CERT_KEY_TYPE):
     os.makedirs(cert_dir, exist_ok=True)
     cert_file = f"{cert_dir}/cert.pem"
     key_file = f"{cert_dir}/key.pem"
     
     if os.path.exists(cert_file) and os.path.exists(key_file):
-        print(f"证书已存在于 {cert_dir}")
-        return cert_file, key_file
-    
-    print(f"为域名 {domain} 创建自签证书...")
+        if not certificate_expiring(cert_dir):
+            print(f"证书已存在于 {cert_dir}")
+            return cert_file, key_file
+        print(f"{cert_dir} 中的证书即将过期，重新生成")
     
-    cmd = [
-        "openssl", "req", "-x509", "-newkey", "rsa:2048", 
-        "-keyout", key_file, "-out", cert_file,
-        "-days", "3650", "-nodes", "-subj", f"/CN={domain}"
-    ]
+    print(f"为域名 {domain} 创建{key_type.upper()}自签证书...")
     
     try:
-        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        cert_pem, key_pem, not_after = generate_certificate(domain, key_type)
+        info = write_certificate(cert_dir, domain, key_type, cert_pem, key_pem, not_after)
         print(f"证书已创建: {cert_file}, {key_file}")
+        print(f"SHA-256指纹: {info['sha256']}")
         return cert_file, key_file
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         print(f"创建证书失败: {e}")
         return None, None
 
+# 证书是否已过期或将在CERT_RENEW_BEFORE天内过期 (无法读取到期时间时视为未过期)
+def certificate_expiring(cert_dir=CERT_DIR):
+    info = load_certificate_info(cert_dir)
+    if not info or not info.get("not_after"):
+        return False
+    return info["not_after"] - time.time() < CERT_RENEW_BEFORE * 86400
+
+# 当前使用的sing-box服务 (分片模式下为各分片服务)
+def singbox_services():
+    shard_count = load_shard_count()
+    return [shard_service(shard) for shard in range(shard_count)] if shard_count > 1 else ["sing-box"]
+
+# 重载所有sing-box实例 (分片模式下逐个重载分片)
+def reload_all_services():
+    shard_count = load_shard_count()
+    if shard_count > 1:
+        return all([reload_service(None, None, shard_config_file(shard), shard_service(shard))
+                    for shard in range(shard_count)])
+    return reload_service()
+
+# 轮换证书: 即将过期、密钥类型不同或force时重新生成，写入后只重载一次
+def rotate_certificate(key_type=CERT_KEY_TYPE, domain=None, force=False, cert_dir=CERT_DIR):
+    info = load_certificate_info(cert_dir)
+    if not domain:
+        config = load_config()
+        hy2 = build_user_index(config)["hysteria2"] if config else None
+        domain = (hy2 or {}).get("tls", {}).get("server_name") or (info or {}).get("domain") or "www.speedtest.net"
+    
+    if info and not force:
+        remaining = (info.get("not_after") or 0) - time.time()
+        if info.get("key_type") == key_type and remaining > CERT_RENEW_BEFORE * 86400:
+            print(f"证书有效期还剩 {remaining / 86400:.0f} 天，无需轮换")
+            return True
+    
+    start = time.monotonic()
+    try:
+        cert_pem, key_pem, not_after = generate_certificate(domain, key_type)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"生成证书失败: {e}")
+        return False
+    with ConfigLock():
+        info = write_certificate(cert_dir, domain, key_type, cert_pem, key_pem, not_after)
+    print(f"已生成新的{key_type.upper()}证书 (耗时 {(time.monotonic() - start) * 1000:.0f} ms)")
+    print(f"SHA-256指纹: {info['sha256']}")
+    return reload_all_services()
+
+# 显示证书状态
+def show_certificate_info(cert_dir=CERT_DIR):
+    info = load_certificate_info(cert_dir)
+    if not info:
+        print(f"{cert_dir} 中没有证书")
+        return False
+    print("\n=== 证书信息 ===")
+    print(f"域名: {info.get('domain') or '未知'}")
+    print(f"密钥类型: {info.get('key_type')}")
+    if info.get("not_after"):
+        remaining = (info["not_after"] - time.time()) / 86400
+        print(f"到期时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(info['not_after']))} (剩余 {remaining:.0f} 天)")
+    print(f"SHA-256指纹: {info['sha256']}")
+    return True
+
 # 管理UFW端口
 def manage_ufw_port(port, action="allow"):
     # 检查UFW状态
@@ -267,6 +935,130 @@ def manage_ufw_port(port, action="allow"):
         print(f"UFW操作失败: {e}")
         return False
 
+# 解析ufw端口规则，如 "443"、"443/udp"、"20000:20010/tcp"
+def parse_ufw_port_spec(spec):
+    port_part, _, proto = spec.partition("/")
+    low, _, high = port_part.partition(":")
+    low = int(low)
+    high = int(high) if high else low
+    return low, high, proto or "any"
+
+# 读取ufw已添加的放行规则 (一次调用，ufw未启用时同样有效)
+def get_ufw_rules():
+    result = subprocess.run(["ufw", "show", "added"], capture_output=True, text=True)
+    rules = []
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        # 只处理简单的 "ufw allow <端口>" 规则
+        if len(parts) != 3 or parts[:2] != ["ufw", "allow"]:
+            continue
+        try:
+            rules.append((parts[2],) + parse_ufw_port_spec(parts[2]))
+        except ValueError:
+            continue
+    return rules
+
+# 从配置中获取需要开放的端口 {(端口, 协议)}，没有用户的入站不开放，分片模式下包含各分片端口
+def get_config_ports(config):
+    ports = set()
+    shard_count = load_shard_count()
+    for inbound in config.get("inbounds", []):
+        port = inbound.get("listen_port")
+        if not port or not inbound.get("users"):
+            continue
+        proto = "udp" if inbound.get("type") in ("hysteria2", "tuic") else "tcp"
+        for shard in range(shard_count):
+            ports.add((int(port) + shard, proto))
+    return ports
+
+# 将端口合并为ufw规则，连续端口合并为区间
+def merge_port_ranges(ports):
+    specs = []
+    for proto in sorted({proto for _, proto in ports}):
+        numbers = sorted(port for port, p in ports if p == proto)
+        start = prev = numbers[0]
+        for port in numbers[1:] + [None]:
+            if port is not None and port == prev + 1:
+                prev = port
+                continue
+            specs.append(f"{start}/{proto}" if start == prev else f"{start}:{prev}/{proto}")
+            if port is not None:
+                start = prev = port
+    return specs
+
+# 按配置同步防火墙规则 (只比较一次，只变更有差异的端口)
+def reconcile_firewall(config):
+    if not shutil.which("ufw"):
+        print("未安装UFW，跳过防火墙同步")
+        return False
+    
+    try:
+        rules = get_ufw_rules()
+    except Exception as e:
+        print(f"读取UFW规则失败: {e}")
+        return False
+    
+    # 由本工具管理的规则: 记录文件中的规则 + 旧版本按入站端口添加的规则
+    managed = set(load_firewall_state().get("rules", []))
+    inbound_ports = {int(i["listen_port"]) for i in config.get("inbounds", []) if i.get("listen_port")}
+    managed.update(spec for spec, low, high, proto in rules
+                   if proto == "any" and low == high and low in inbound_ports)
+    
+    desired = get_config_ports(config)
+    to_delete = []
+    kept_rules = []
+    for rule in rules:
+        spec, low, high, proto = rule
+        wanted = proto in ("tcp", "udp", "any") and all(
+            any((port, p) in desired for p in (("tcp", "udp") if proto == "any" else (proto,)))
+            for port in range(low, high + 1))
+        if spec in managed and not wanted:
+            to_delete.append(spec)
+        else:
+            kept_rules.append(rule)
+    
+    # 已被现有规则覆盖的端口不再添加
+    to_add = {(port, proto) for port, proto in desired
+              if not any(low <= port <= high and p in (proto, "any") for _, low, high, p in kept_rules)}
+    add_specs = merge_port_ranges(to_add) if to_add else []
+    
+    if not to_delete and not add_specs:
+        # 记录接管的旧规则，入站端口变化后才能被清理
+        save_json(FIREWALL_STATE_FILE, {"rules": sorted(managed & {spec for spec, _, _, _ in kept_rules})})
+        print("防火墙规则已是最新")
+        return True
+    
+    ok = True
+    for spec in to_delete:
+        try:
+            subprocess.run(["ufw", "delete", "allow", spec], check=True, stdout=subprocess.DEVNULL)
+            print(f"端口 {spec} 已关闭")
+            managed.discard(spec)
+        except subprocess.CalledProcessError as e:
+            print(f"关闭端口失败: {e}")
+            ok = False
+    for spec in add_specs:
+        try:
+            subprocess.run(["ufw", "allow", spec], check=True, stdout=subprocess.DEVNULL)
+            print(f"端口 {spec} 已开放")
+            managed.add(spec)
+        except subprocess.CalledProcessError as e:
+            print(f"开放端口失败: {e}")
+            ok = False
+    
+    # 只记录仍然存在的规则
+    existing = {spec for spec, _, _, _ in kept_rules} | set(add_specs)
+    save_json(FIREWALL_STATE_FILE, {"rules": sorted(managed & existing)})
+    return ok
+
+# 读取防火墙规则记录
+def load_firewall_state():
+    try:
+        with open(FIREWALL_STATE_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
 # 在终端中显示二维码
 def display_terminal_qrcode(url):
     try:
@@ -282,44 +1074,119 @@ def display_terminal_qrcode(url):
     except Exception as e:
         print(f"显示二维码失败: {e}")
 
+# 二维码缓存文件路径 (按链接内容哈希命名，相同链接不重复渲染)
+def qrcode_cache_path(url, save_dir=QRCODE_DIR):
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(save_dir, f"{digest}.png")
+
+# 渲染二维码图片 (可在子进程中执行)
+def render_qrcode_image(url, filename):
+    import qrcode
+    
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color="black", back_color="white")
+    
+    # 先写临时文件再重命名，避免留下不完整的缓存
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    img.save(tmp_file, format="PNG")
+    os.replace(tmp_file, filename)
+    return filename
+
+# 清理二维码缓存 (超出数量或大小上限时按最近使用时间淘汰)
+def prune_qrcode_cache(save_dir=QRCODE_DIR, max_files=QRCODE_CACHE_MAX_FILES, max_bytes=QRCODE_CACHE_MAX_BYTES):
+    try:
+        entries = []
+        total = 0
+        with os.scandir(save_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".png"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+    except OSError:
+        return
+    
+    if len(entries) <= max_files and total <= max_bytes:
+        return
+    
+    entries.sort()
+    count = len(entries)
+    for mtime, size, path in entries:
+        if count <= max_files and total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        count -= 1
+        total -= size
+
 # 生成二维码图片
-def generate_qrcode_image(url, username, node_name="", save_dir="/tmp/qrcode"):
+def generate_qrcode_image(url, username, node_name="", save_dir=QRCODE_DIR):
     try:
-        import qrcode
-        from PIL import Image
-        
-        # 创建保存目录
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # 生成二维码
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # 生成文件名
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        node_name = node_name.replace(" ", "_") if node_name else username
-        filename = f"{save_dir}/{username}_{node_name}_{timestamp}.png"
+        filename = qrcode_cache_path(url, save_dir)
+        if os.path.exists(filename):
+            # 更新访问时间，供缓存淘汰使用
+            os.utime(filename)
+        else:
+            os.makedirs(save_dir, exist_ok=True)
+            render_qrcode_image(url, filename)
+            prune_qrcode_cache(save_dir)
         
-        # 保存图片
-        img.save(filename)
-        print(f"二维码已保存到 {filename}")
+        label = node_name or username
+        print(f"{label} 二维码已保存到 {filename}")
         return filename
     except Exception as e:
         print(f"生成二维码图片失败: {e}")
         return None
 
+# 批量生成二维码图片 (只渲染缓存中没有的链接，多进程并行)
+def generate_qrcode_images(urls, save_dir=QRCODE_DIR, max_workers=None):
+    results = {}
+    pending = {}
+    for url in urls:
+        filename = qrcode_cache_path(url, save_dir)
+        if os.path.exists(filename):
+            os.utime(filename)
+            results[url] = filename
+        else:
+            pending[url] = filename
+    
+    if not pending:
+        return results
+    
+    try:
+        os.makedirs(save_dir, exist_ok=True)
+        if len(pending) == 1:
+            for url, filename in pending.items():
+                results[url] = render_qrcode_image(url, filename)
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                futures = {pool.submit(render_qrcode_image, url, filename): url
+                           for url, filename in pending.items()}
+                for future in as_completed(futures):
+                    try:
+                        results[futures[future]] = future.result()
+                    except Exception as e:
+                        print(f"生成二维码图片失败: {e}")
+    except Exception as e:
+        print(f"生成二维码图片失败: {e}")
+    
+    prune_qrcode_cache(save_dir)
+    return results
+
 # 生成VLESS URL
 def generate_vless_url(info, node_name=None):
     uuid_str = info.get("uuid", "")
-    server_ip = info.get("server_ip", get_server_ip())
+    server_ip = info["server_ip"] if "server_ip" in info else get_server_ip()
     port = info.get("port", 18890)
     flow = info.get("flow", "xtls-rprx-vision")
     security = "reality"
@@ -338,7 +1205,7 @@ def generate_vless_url(info, node_name=None):
 # 生成Hysteria2 URL
 def generate_hysteria2_url(info, node_name=None):
     password = info.get("password", "")
-    server_ip = info.get("server_ip", get_server_ip())
+    server_ip = info["server_ip"] if "server_ip" in info else get_server_ip()
     port = info.get("port", 443)
     sni = info.get("sni", "www.speedtest.net")
     insecure = "1" if info.get("insecure", True) else "0"
@@ -351,70 +1218,730 @@ def generate_hysteria2_url(info, node_name=None):
     url = f"hysteria2://{encoded_password}@{server_ip}:{port}?sni={sni}&alpn=h3,h2,http/1.1&obfs=salamander&obfs-password=ZXCZ123%40%21&insecure={insecure}#{encoded_node_name}"
     return url
 
+# 读取Reality公钥
+def load_reality_pubkey():
+    keys_file = Path("/etc/sing-box/cert/keys.json")
+    if keys_file.exists():
+        try:
+            with open(keys_file, 'r') as f:
+                keys = json.load(f)
+                return keys.get("reality", {}).get("public_key", "")
+        except:
+            pass
+    return ""
+
+# 读取节点名称
+def load_node_names():
+    node_name_file = Path("/etc/sing-box/node_names.json")
+    if node_name_file.exists():
+        try:
+            with open(node_name_file, 'r') as f:
+                return json.load(f)
+        except:
+            pass
+    return {}
+
+# 建立用户索引 (一次遍历所有入站)
+# names: 用户名 -> {"vless": (入站, 用户), "hysteria2": (入站, 用户)}
+# uuids: uuid -> (入站, 用户), passwords: 密码 -> (入站, 用户)
+def build_user_index(config):
+    index = {"names": {}, "uuids": {}, "passwords": {}, "vless": None, "hysteria2": None}
+    for inbound in config.get("inbounds", []):
+        inbound_type = inbound.get("type")
+        if inbound_type not in ("vless", "hysteria2"):
+            continue
+        index[inbound_type] = inbound
+        for user in inbound.get("users", []):
+            username = user.get("name")
+            if username:
+                index["names"].setdefault(username, {})[inbound_type] = (inbound, user)
+            if inbound_type == "vless" and user.get("uuid"):
+                index["uuids"][user["uuid"]] = (inbound, user)
+            elif inbound_type == "hysteria2" and user.get("password"):
+                index["passwords"][user["password"]] = (inbound, user)
+    return index
+
+# 获取VLESS入站的链接参数
+def get_vless_inbound_params(inbound, server_ip, reality_pubkey=""):
+    tls = inbound.get("tls", {})
+    reality = tls.get("reality", {})
+    short_id = reality.get("short_id", [""])[0] if isinstance(reality.get("short_id"), list) else reality.get("short_id", "")
+    return {
+        "server_ip": server_ip,
+        "port": inbound.get("listen_port"),
+        "sni": tls.get("server_name", reality.get("server_name", "www.speedtest.net")),
+        "fp": reality.get("fingerprint", "chrome"),
+        "pbk": reality.get("public_key") or reality_pubkey,
+        "sid": short_id
+    }
+
+# 获取Hysteria2入站的链接参数
+def get_hy2_inbound_params(inbound, server_ip):
+    tls = inbound.get("tls", {})
+    return {
+        "server_ip": server_ip,
+        "port": inbound.get("listen_port"),
+        "sni": tls.get("server_name", "www.speedtest.net"),
+        "insecure": tls.get("insecure", True)
+    }
+
+# 根据索引生成单个用户的链接
+def build_user_links(entry, node_name, server_ip, reality_pubkey, params_cache):
+    info = {}
+    # 分片模式下用户连接所在分片的端口
+    if "shards" not in params_cache:
+        params_cache["shards"] = load_shard_count()
+    
+    if "vless" in entry:
+        inbound, user = entry["vless"]
+        key = ("vless", id(inbound))
+        if key not in params_cache:
+            params_cache[key] = get_vless_inbound_params(inbound, server_ip, reality_pubkey)
+        port = params_cache[key]["port"] + shard_for_user(user.get("name", ""), params_cache["shards"])
+        info["uuid"] = user.get("uuid")
+        info["vless_port"] = port
+        info["vless_url"] = generate_vless_url(dict(params_cache[key], uuid=user.get("uuid"), port=port,
+                                                    flow=user.get("flow", "xtls-rprx-vision")), node_name)
+    if "hysteria2" in entry:
+        inbound, user = entry["hysteria2"]
+        key = ("hysteria2", id(inbound))
+        if key not in params_cache:
+            params_cache[key] = get_hy2_inbound_params(inbound, server_ip)
+        port = params_cache[key]["port"] + shard_for_user(user.get("name", ""), params_cache["shards"])
+        info["hy2_password"] = user.get("password")
+        info["hy2_port"] = port
+        info["hysteria2_url"] = generate_hysteria2_url(dict(params_cache[key], password=user.get("password"), port=port),
+                                                       node_name)
+    return info
+
 # 从配置中获取用户信息
-def get_users_from_config(config):
-    users_info = {}
+def get_users_from_config(config, index=None, node_names=None):
+    if index is None:
+        index = build_user_index(config)
+    node_names = node_names or {}
     server_ip = get_server_ip()
+    reality_pubkey = load_reality_pubkey()
+    params_cache = {}
     
-    # 获取Reality公钥
-    reality_pubkey = ""
-    for inbound in config["inbounds"]:
-        if inbound.get("type") == "vless" and inbound.get("tls", {}).get("reality"):
-            reality_pubkey = inbound["tls"]["reality"].get("public_key", "")
-            break
-    
-    # 获取VLESS用户
-    for inbound in config["inbounds"]:
-        if inbound.get("type") == "vless":
-            for user in inbound.get("users", []):
-                username = user.get("name")
-                if username:
-                    users_info[username] = users_info.get(username, {})
-                    users_info[username]["uuid"] = user.get("uuid")
-                    users_info[username]["vless_port"] = inbound.get("listen_port")
-                    
-                    # 生成VLESS URL
-                    short_id = inbound["tls"]["reality"].get("short_id", [""])[0] if isinstance(inbound["tls"]["reality"].get("short_id"), list) else inbound["tls"]["reality"].get("short_id", "")
-                    sni = inbound["tls"]["reality"].get("server_name", "www.speedtest.net")
-                    fp = inbound["tls"]["reality"].get("fingerprint", "chrome")
-                    flow = user.get("flow", "xtls-rprx-vision")
-                    
-                    vless_url = generate_vless_url({
-                        "uuid": user.get("uuid"),
-                        "server_ip": server_ip,
-                        "port": inbound.get("listen_port"),
-                        "sni": sni,
-                        "fp": fp,
-                        "pbk": reality_pubkey,
-                        "sid": short_id,
-                        "flow": flow
-                    }, username)
-                    users_info[username]["vless_url"] = vless_url
-    
-    # 获取Hysteria2用户
-    for inbound in config["inbounds"]:
-        if inbound.get("type") == "hysteria2":
-            for user in inbound.get("users", []):
-                username = user.get("name")
-                if username and username in users_info:
-                    users_info[username]["hy2_password"] = user.get("password")
-                    users_info[username]["hy2_port"] = inbound.get("listen_port")
-                    
-                    # 生成Hysteria2 URL
-                    sni = inbound.get("tls", {}).get("server_name", "www.speedtest.net")
-                    insecure = inbound.get("tls", {}).get("insecure", True)
-                    
-                    hy2_url = generate_hysteria2_url({
-                        "password": user.get("password"),
-                        "server_ip": server_ip,
-                        "port": inbound.get("listen_port"),
-                        "sni": sni,
-                        "insecure": insecure
-                    }, username)
-                    users_info[username]["hysteria2_url"] = hy2_url
-    
+    users_info = {}
+    for username, entry in index["names"].items():
+        # 只列出包含VLESS的用户
+        if "vless" not in entry:
+            continue
+        users_info[username] = build_user_links(entry, node_names.get(username, username),
+                                                server_ip, reality_pubkey, params_cache)
     return users_info
 
+# 用户数据库表结构 (name、uuid、password均有唯一索引)
+USER_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    uuid TEXT UNIQUE,
+    password TEXT UNIQUE,
+    flow TEXT NOT NULL DEFAULT 'xtls-rprx-vision',
+    node_name TEXT,
+    created_at INTEGER NOT NULL,
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# SQLite的REGEXP函数实现
+@functools.lru_cache(maxsize=32)
+def compile_user_regex(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+def sqlite_regexp(pattern, value):
+    return value is not None and compile_user_regex(pattern).search(value) is not None
+
+# 打开用户数据库 (首次使用时从config.json和node_names.json导入现有用户)
+def open_user_db(db_file=USER_DB_FILE, config_file="/etc/sing-box/config.json"):
+    import sqlite3
+    db_file = Path(db_file)
+    db_file.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(db_file), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.create_function("REGEXP", 2, sqlite_regexp, deterministic=True)
+    conn.executescript(USER_DB_SCHEMA)
+    
+    if get_db_meta(conn, "imported") is None:
+        config_file = Path(config_file)
+        if config_file.exists():
+            with open(config_file, 'r') as f:
+                config = json.load(f)
+            count = import_users_from_config(conn, config, load_node_names())
+            set_db_meta(conn, "rendered_revision", get_db_meta(conn, "revision", "0"))
+            print(f"已从配置文件导入 {count} 个用户到 {db_file}")
+        set_db_meta(conn, "imported", "1")
+        conn.commit()
+    return conn
+
+# 读取数据库元信息
+def get_db_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+# 写入数据库元信息
+def set_db_meta(conn, key, value):
+    conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                 "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, str(value)))
+
+# 用户数据变化后递增版本号，用于判断是否需要重新生成配置
+# 指定expected时先确认版本号未被其他进程修改
+def bump_db_revision(conn, expected=None):
+    revision = get_db_meta(conn, "revision", "0")
+    if expected is not None and revision != expected:
+        raise ConfigConflictError(f"用户数据版本已从 {expected} 变为 {revision}")
+    set_db_meta(conn, "revision", int(revision) + 1)
+
+# 并发修改冲突 (版本号或配置文件哈希与读取时不一致)
+class ConfigConflictError(Exception):
+    pass
+
+# 配置修改的进程间互斥锁 (fcntl建议锁，同一进程内可重入)
+class ConfigLock:
+    depth = 0
+    lock_file = None
+    
+    def __enter__(self):
+        if ConfigLock.depth == 0:
+            CONFIG_LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+            f = builtins.open(CONFIG_LOCK_FILE, 'a')
+            deadline = time.monotonic() + CONFIG_LOCK_TIMEOUT
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        f.close()
+                        raise TimeoutError(f"等待配置锁超时: {CONFIG_LOCK_FILE}")
+                    time.sleep(0.05)
+            ConfigLock.lock_file = f
+        ConfigLock.depth += 1
+        return self
+    
+    def __exit__(self, *exc):
+        ConfigLock.depth -= 1
+        if ConfigLock.depth == 0:
+            fcntl.flock(ConfigLock.lock_file, fcntl.LOCK_UN)
+            ConfigLock.lock_file.close()
+            ConfigLock.lock_file = None
+        return False
+
+# 判断是否为可重试的并发冲突
+def is_config_conflict(error):
+    import sqlite3
+    if isinstance(error, (ConfigConflictError, sqlite3.IntegrityError)):
+        return True
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+# 持有配置锁执行修改，遇到并发冲突时随机退避后重试 (每次重试都重新读取数据)
+def with_config_retry(func, retries=CONFIG_EDIT_RETRIES):
+    for attempt in range(retries):
+        try:
+            with ConfigLock():
+                return func()
+        except Exception as e:
+            if not is_config_conflict(e) or attempt == retries - 1:
+                raise
+            delay = 0.05 * (2 ** attempt) * (1 + secrets.randbelow(100) / 100)
+            print(f"检测到并发修改 ({e})，{delay:.2f} 秒后重试...")
+            time.sleep(delay)
+
+# 在事务中修改用户数据: func返回真值表示有修改，此时校验并递增版本号
+def run_user_transaction(conn, func):
+    def attempt():
+        expected = get_db_meta(conn, "revision", "0")
+        with conn:
+            result = func(conn)
+            if result:
+                bump_db_revision(conn, expected)
+        return result
+    return with_config_retry(attempt)
+
+# 修改config.json: mutate就地修改配置，返回False时放弃
+# 写入前确认文件未被其他程序修改，返回 (旧配置哈希, 新配置)，未修改时返回None
+def edit_config(mutate, config_file="/etc/sing-box/config.json"):
+    def attempt():
+        config = load_config(config_file)
+        if not config:
+            return None
+        old_hash = config_hash(config)
+        if mutate(config) is False:
+            return None
+        current = load_config(config_file)
+        if not current or config_hash(current) != old_hash:
+            raise ConfigConflictError(f"{config_file} 已被其他程序修改")
+        save_json(config_file, config, validate=check_config)
+        return old_hash, config
+    try:
+        return with_config_retry(attempt)
+    except ConfigInvalidError as e:
+        print(e)
+        return None
+
+# 从配置文件导入用户 (replace为True时先清空现有用户)
+def import_users_from_config(conn, config, node_names=None, replace=False):
+    node_names = node_names or {}
+    index = build_user_index(config)
+    now = int(time.time())
+    rows = []
+    for username, entry in index["names"].items():
+        vless_user = entry["vless"][1] if "vless" in entry else {}
+        hy2_user = entry["hysteria2"][1] if "hysteria2" in entry else {}
+        rows.append((username, vless_user.get("uuid"), hy2_user.get("password"),
+                     vless_user.get("flow", "xtls-rprx-vision"), node_names.get(username), now))
+    with conn:
+        if replace:
+            conn.execute("DELETE FROM users")
+        conn.executemany("INSERT OR IGNORE INTO users (name, uuid, password, flow, node_name, created_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        bump_db_revision(conn)
+    return len(rows)
+
+# 生成数据库中不重复的UUID
+def db_new_uuid(conn):
+    while True:
+        user_uuid = str(uuid.uuid4())
+        if not conn.execute("SELECT 1 FROM users WHERE uuid = ?", (user_uuid,)).fetchone():
+            return user_uuid
+
+# 生成数据库中不重复的Hysteria2密码
+def db_new_password(conn, length=16):
+    while True:
+        password = random_string(length)
+        if not conn.execute("SELECT 1 FROM users WHERE password = ?", (password,)).fetchone():
+            return password
+
+# 按用户名查询用户
+def db_get_user(conn, username):
+    return conn.execute("SELECT * FROM users WHERE name = ?", (username,)).fetchone()
+
+# 查询用户 (支持过滤、排序和分页)，返回 (总数, 当前页记录)
+# sort: "config" 添加顺序, "name" 用户名, "node" 节点名称
+def db_query_users(conn, pattern=None, regex=False, sort="config", limit=-1, offset=0):
+    where = ""
+    params = []
+    if pattern:
+        if regex:
+            where = "WHERE name REGEXP ? OR node_name REGEXP ?"
+            params = [pattern, pattern]
+        else:
+            where = "WHERE instr(lower(name), ?) > 0 OR instr(lower(COALESCE(node_name, '')), ?) > 0"
+            params = [pattern.lower(), pattern.lower()]
+    order = {"config": "id", "name": "name", "node": "COALESCE(node_name, name), name"}.get(sort, "id")
+    total = conn.execute(f"SELECT COUNT(*) FROM users {where}", params).fetchone()[0]
+    rows = conn.execute(f"SELECT * FROM users {where} ORDER BY {order} LIMIT ? OFFSET ?",
+                        params + [limit, offset]).fetchall()
+    return total, rows
+
+# 将数据库用户转换为索引条目格式，供生成链接使用
+def db_user_entry(row, vless_inbound, hy2_inbound):
+    entry = {}
+    if row["uuid"] and vless_inbound is not None:
+        entry["vless"] = (vless_inbound, {"name": row["name"], "uuid": row["uuid"], "flow": row["flow"]})
+    if row["password"] and hy2_inbound is not None:
+        entry["hysteria2"] = (hy2_inbound, {"name": row["name"], "password": row["password"]})
+    return entry
+
+# 根据数据库生成config.json和node_names.json (数据未变化时跳过)，分片模式下同时生成各分片配置
+# 返回需要重载的服务列表 [(服务名, 配置文件, 旧配置哈希, 新配置哈希)]
+def render_config(conn, config_file="/etc/sing-box/config.json", force=False):
+    try:
+        return with_config_retry(lambda: render_config_locked(conn, config_file, force))
+    except ConfigInvalidError as e:
+        print(e)
+        return []
+
+def render_config_locked(conn, config_file, force):
+    revision = get_db_meta(conn, "revision", "0")
+    if not force and get_db_meta(conn, "rendered_revision") == revision:
+        return []
+    
+    config = load_config(config_file)
+    if not config:
+        return []
+    old_hash = config_hash(config)
+    
+    vless_users = []
+    hy2_users = []
+    node_names = {}
+    for row in conn.execute("SELECT name, uuid, password, flow, node_name FROM users ORDER BY id"):
+        if row["uuid"]:
+            vless_users.append({"name": row["name"], "uuid": row["uuid"], "flow": row["flow"]})
+        if row["password"]:
+            hy2_users.append({"name": row["name"], "password": row["password"]})
+        if row["node_name"] and row["node_name"] != row["name"]:
+            node_names[row["name"]] = row["node_name"]
+    
+    index = build_user_index(config)
+    if index["vless"] is not None:
+        index["vless"]["users"] = vless_users
+    if index["hysteria2"] is not None:
+        index["hysteria2"]["users"] = hy2_users
+    sync_traffic_stats_users(config)
+    
+    # 写入前确认模板未被其他程序修改
+    current = load_config(config_file)
+    if not current or config_hash(current) != old_hash:
+        raise ConfigConflictError(f"{config_file} 已被其他程序修改")
+    save_json(config_file, config, validate=check_config)
+    save_json(Path("/etc/sing-box/node_names.json"), node_names)
+    
+    shard_count = load_shard_count()
+    if shard_count > 1:
+        targets = render_shard_configs(config, shard_count)
+    else:
+        targets = [("sing-box", config_file, old_hash, config_hash(config))]
+    
+    with conn:
+        set_db_meta(conn, "rendered_revision", revision)
+    return targets
+
+# 用户数据变化后重新生成配置并重载服务 (分片模式下只重载有变化的分片)
+def apply_user_changes(conn, force=False):
+    targets = render_config(conn, force=force)
+    for service, config_file, old_hash, new_hash in targets:
+        reload_service(old_hash, new_hash, config_file, service)
+    return targets
+
+# 配置模板 (config.json) 被直接修改后重新生成并重载
+def apply_config_change(old_hash, config):
+    if load_shard_count() > 1:
+        conn = open_user_db()
+        try:
+            apply_user_changes(conn, force=True)
+        finally:
+            conn.close()
+    else:
+        reload_service(old_hash, config_hash(config))
+
+# 读取分片数量 (1表示不分片)
+def load_shard_count():
+    try:
+        with open(SHARD_FILE, 'r') as f:
+            return max(1, int(json.load(f).get("count", 1)))
+    except Exception:
+        return 1
+
+# 构建一致性哈希环 (每个分片若干虚拟节点)
+@functools.lru_cache(maxsize=8)
+def build_shard_ring(count):
+    ring = sorted((int.from_bytes(hashlib.sha1(f"shard-{shard}-{vnode}".encode()).digest()[:8], "big"), shard)
+                  for shard in range(count) for vnode in range(SHARD_VIRTUAL_NODES))
+    return [point for point, _ in ring], [shard for _, shard in ring]
+
+# 按一致性哈希计算用户所在分片，增加分片时只有少量用户迁移
+def shard_for_user(username, count):
+    if count <= 1:
+        return 0
+    points, shards = build_shard_ring(count)
+    key = int.from_bytes(hashlib.sha1(username.encode("utf-8")).digest()[:8], "big")
+    return shards[bisect.bisect(points, key) % len(points)]
+
+# 分片配置文件及服务名 (与sing-box@.service模板的 /etc/sing-box/%i.json 对应)
+def shard_config_file(shard):
+    return Path(f"/etc/sing-box/{shard}.json")
+
+def shard_service(shard):
+    return f"sing-box@{shard}"
+
+# 生成各分片配置: 每个分片只包含分配给它的用户，端口依次加上分片编号
+def render_shard_configs(config, shard_count):
+    targets = []
+    for shard in range(shard_count):
+        shard_config = json.loads(json.dumps(config))
+        for inbound in shard_config.get("inbounds", []):
+            if inbound.get("listen_port"):
+                inbound["listen_port"] += shard
+            if inbound.get("type") in ("vless", "hysteria2"):
+                inbound["users"] = [u for u in inbound.get("users", [])
+                                    if shard_for_user(u.get("name", ""), shard_count) == shard]
+        v2ray_api = shard_config.get("experimental", {}).get("v2ray_api")
+        if v2ray_api and v2ray_api.get("listen"):
+            v2ray_api["listen"] = shard_address(v2ray_api["listen"], shard)
+        
+        shard_file = shard_config_file(shard)
+        old_config = load_config(shard_file) if shard_file.exists() else None
+        save_json(shard_file, shard_config, validate=check_config)
+        targets.append((shard_service(shard), shard_file,
+                        config_hash(old_config) if old_config else None, config_hash(shard_config)))
+    return targets
+
+# 计算分片的监听地址 (端口加上分片编号)
+def shard_address(address, shard):
+    host, _, port = address.rpartition(":")
+    return f"{host}:{int(port) + shard}"
+
+# 设置分片数量并切换服务
+def set_shard_count(count):
+    if count < 1:
+        print("分片数量必须大于0")
+        return False
+    config = load_config()
+    if not config:
+        return False
+    
+    old_count = load_shard_count()
+    save_json(SHARD_FILE, {"count": count})
+    
+    conn = open_user_db()
+    try:
+        if count > 1:
+            # 停止单实例服务，启动各分片
+            subprocess.run(["systemctl", "disable", "--now", "sing-box"], check=False)
+            for service, config_file, _, new_hash in render_config(conn, force=True):
+                subprocess.run(["systemctl", "enable", service], check=False)
+                reload_service(None, new_hash, config_file, service)
+        else:
+            render_config(conn, force=True)
+            subprocess.run(["systemctl", "enable", "sing-box"], check=False)
+            restart_service()
+    finally:
+        conn.close()
+    
+    # 停用多余的分片
+    first_unused = count if count > 1 else 0
+    for shard in range(first_unused, old_count if old_count > 1 else 0):
+        subprocess.run(["systemctl", "disable", "--now", shard_service(shard)], check=False)
+        try:
+            shard_config_file(shard).unlink()
+        except OSError:
+            pass
+    
+    reconcile_firewall(load_config() or config)
+    print(f"分片数量已设置为 {count}")
+    return True
+
+# 显示分片状态
+def show_shards():
+    count = load_shard_count()
+    if count <= 1:
+        print("未启用分片")
+        return True
+    conn = open_user_db()
+    try:
+        sizes = [0] * count
+        for row in conn.execute("SELECT name FROM users"):
+            sizes[shard_for_user(row["name"], count)] += 1
+    finally:
+        conn.close()
+    print(f"\n=== 分片状态 (共 {count} 个) ===")
+    for shard, size in enumerate(sizes):
+        active = "运行中" if service_is_active(shard_service(shard)) else "未运行"
+        print(f"{shard_service(shard)}: {size} 个用户, {active}")
+    return True
+
+# 获取默认路由所在的网卡
+def get_default_interface():
+    try:
+        with open("/proc/net/route", 'r') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 1 and fields[1] == "00000000":
+                    return fields[0]
+    except OSError:
+        pass
+    return None
+
+# 检测网卡速率 (Mbps)，优先使用默认路由网卡，否则取物理网卡中的最大值，无法检测时返回None
+def detect_link_speed():
+    def read_speed(interface):
+        try:
+            speed = int((SYS_CLASS_NET / interface / "speed").read_text().strip())
+            return speed if speed > 0 else None
+        except (OSError, ValueError):
+            return None
+    
+    default = get_default_interface()
+    if default and read_speed(default):
+        return read_speed(default)
+    try:
+        # 虚拟网卡 (lo、bridge、tun等) 没有device目录
+        speeds = [read_speed(path.name) for path in SYS_CLASS_NET.iterdir() if (path / "device").exists()]
+    except OSError:
+        return None
+    speeds = [speed for speed in speeds if speed]
+    return max(speeds) if speeds else None
+
+# 读取配置的出入口限速 (Mbps，VPS套餐带宽等)
+def load_bandwidth_limits():
+    try:
+        with open(BANDWIDTH_FILE, 'r') as f:
+            limits = json.load(f)
+        return limits.get("egress_mbps"), limits.get("ingress_mbps")
+    except (OSError, ValueError):
+        return None, None
+
+# 计算Hysteria2的 (up_mbps, down_mbps): 指定档位时使用档位值，否则按网卡速率和限速取较小值并留出余量
+def compute_hy2_bandwidth(tier=None):
+    if tier:
+        return HY2_BANDWIDTH_TIERS[tier]
+    link = detect_link_speed()
+    egress, ingress = load_bandwidth_limits()
+    
+    def size(limit):
+        capacity = min(value for value in (link, limit) if value) if (link or limit) else None
+        if capacity is None:
+            return HY2_DEFAULT_MBPS
+        return max(10, int(capacity * HY2_BANDWIDTH_HEADROOM))
+    return size(egress), size(ingress)
+
+# 调整现有Hysteria2入站的带宽 (就地修改配置，只重载一次)
+def tune_hy2_bandwidth(tier=None, up_mbps=None, down_mbps=None, dry_run=False):
+    auto_up, auto_down = compute_hy2_bandwidth(tier)
+    up_mbps = up_mbps or auto_up
+    down_mbps = down_mbps or auto_down
+    link = detect_link_speed()
+    egress, ingress = load_bandwidth_limits()
+    print(f"网卡速率: {f'{link} Mbps' if link else '未知'}, 出口限速: {egress or '未设置'}, 入口限速: {ingress or '未设置'}")
+    
+    config = load_config()
+    if not config:
+        return False
+    changes = [(inbound.get("tag") or inbound.get("type"), inbound.get("up_mbps"), inbound.get("down_mbps"))
+               for inbound in config.get("inbounds", []) if inbound.get("type") == "hysteria2"]
+    if not changes:
+        print("配置中没有Hysteria2入站")
+        return False
+    for name, old_up, old_down in changes:
+        print(f"{name}: 上行 {old_up} -> {up_mbps} Mbps, 下行 {old_down} -> {down_mbps} Mbps")
+    if dry_run:
+        return True
+    
+    def set_bandwidth(config):
+        for inbound in config.get("inbounds", []):
+            if inbound.get("type") == "hysteria2":
+                inbound["up_mbps"] = up_mbps
+                inbound["down_mbps"] = down_mbps
+    
+    result = edit_config(set_bandwidth)
+    if not result:
+        return False
+    old_hash, config = result
+    apply_config_change(old_hash, config)
+    return True
+
+# sysctl参数对应的 /proc/sys 文件 (root用于在其他目录下测试)
+def sysctl_path(key, root=None):
+    return Path(LocalExecutor(root).resolve("/proc/sys/" + key.replace(".", "/")))
+
+# 读取sysctl参数当前值 (多个值以单个空格分隔)，不存在时返回None
+def read_sysctl(key, root=None):
+    try:
+        return " ".join(sysctl_path(key, root).read_text().split())
+    except OSError:
+        return None
+
+# 写入sysctl参数
+def write_sysctl(key, value, root=None):
+    with open(sysctl_path(key, root), 'w') as f:
+        f.write(value + "\n")
+
+# 显示方案与当前值的差异，返回有差异的参数 {参数: (当前值, 目标值)}
+def diff_sysctl_profile(profile="default", root=None, quiet=False):
+    changes = {}
+    for key, value in SYSCTL_PROFILES[profile].items():
+        current = read_sysctl(key, root)
+        if current != value:
+            changes[key] = (current, value)
+        if not quiet:
+            mark = "*" if current != value else " "
+            print(f"{mark} {key:<36} {current if current is not None else '(不存在)':>24} -> {value}")
+    if not quiet:
+        print(f"\n{len(changes)} 项需要修改" if changes else "\n当前值与方案一致")
+    return changes
+
+# 应用方案: 备份原始值 (已有备份时保留最初的值)、写入内核参数并持久化到sysctl.d，最后校验
+def apply_sysctl_profile(profile="default", root=None):
+    executor = LocalExecutor(root)
+    changes = diff_sysctl_profile(profile, root)
+    
+    backup_file = Path(executor.resolve(SYSCTL_BACKUP_FILE))
+    if not backup_file.exists():
+        save_json(backup_file, {key: read_sysctl(key, root) for key in SYSCTL_PROFILES[profile]})
+    else:
+        # 合并新方案中之前未备份的参数
+        with open(backup_file, 'r') as f:
+            backup = json.load(f)
+        for key in SYSCTL_PROFILES[profile]:
+            backup.setdefault(key, read_sysctl(key, root))
+        save_json(backup_file, backup)
+    
+    failed = []
+    for key, (_, value) in changes.items():
+        try:
+            write_sysctl(key, value, root)
+        except OSError as e:
+            # BBR未加载时尝试加载内核模块后重试
+            if key == "net.ipv4.tcp_congestion_control" and not root:
+                subprocess.run(["modprobe", f"tcp_{value}"], check=False, capture_output=True)
+                try:
+                    write_sysctl(key, value, root)
+                    continue
+                except OSError:
+                    pass
+            failed.append(key)
+            print(f"设置 {key} 失败: {e}")
+    
+    lines = [f"# 由sing-box管理工具生成 (方案: {profile})"]
+    lines += [f"{key} = {value}" for key, value in SYSCTL_PROFILES[profile].items()]
+    executor.write_bytes(SYSCTL_CONF_FILE, ("\n".join(lines) + "\n").encode("utf-8"))
+    print(f"已写入 {executor.resolve(SYSCTL_CONF_FILE)}")
+    
+    return verify_sysctl_profile(profile, root) and not failed
+
+# 校验方案是否生效
+def verify_sysctl_profile(profile="default", root=None):
+    changes = diff_sysctl_profile(profile, root, quiet=True)
+    for key, (current, value) in changes.items():
+        print(f"未生效: {key} 当前为 {current}，期望 {value}")
+    
+    conf_file = Path(LocalExecutor(root).resolve(SYSCTL_CONF_FILE))
+    if not conf_file.exists():
+        print(f"未持久化: {conf_file} 不存在")
+        return False
+    if not changes:
+        print(f"方案 {profile} 已生效")
+    return not changes
+
+# 回滚: 恢复备份的原始值并删除持久化文件
+def rollback_sysctl_profile(root=None):
+    executor = LocalExecutor(root)
+    backup_file = Path(executor.resolve(SYSCTL_BACKUP_FILE))
+    try:
+        with open(backup_file, 'r') as f:
+            backup = json.load(f)
+    except (OSError, ValueError):
+        print("没有可回滚的备份")
+        return False
+    
+    ok = True
+    for key, value in backup.items():
+        if value is None or read_sysctl(key, root) == value:
+            continue
+        try:
+            write_sysctl(key, value, root)
+            print(f"已恢复 {key} = {value}")
+        except OSError as e:
+            ok = False
+            print(f"恢复 {key} 失败: {e}")
+    
+    for path in (executor.resolve(SYSCTL_CONF_FILE), backup_file):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    print("已回滚内核网络参数")
+    return ok
+
 # 配置sing-box
 def config_singbox():
     # 创建配置目录
@@ -465,6 +1992,9 @@ def config_singbox():
     # 创建自签证书
     cert_file, key_file = create_self_signed_cert(domain=server_name)
     
+    # 按网卡速率和限速确定Hysteria2带宽
+    up_mbps, down_mbps = compute_hy2_bandwidth()
+    
     print("\n正在生成配置文件...")
     
     # 配置模板
@@ -501,8 +2031,8 @@ def config_singbox():
                 "tag": "hy2-in",
                 "listen": "::",
                 "listen_port": hy2_port,
-                "up_mbps": 1000,
-                "down_mbps": 1000,
+                "up_mbps": up_mbps,
+                "down_mbps": down_mbps,
                 "obfs": {
                     "type": "salamander",
                     "password": "ZXCZ123@!"
@@ -536,33 +2066,51 @@ def config_singbox():
         ]
     }
     
-    # 保存配置文件
-    with open(config_file, 'w') as f:
-        json.dump(config, f, indent=4)
-    
-    print(f"配置文件已保存到 {config_file}")
+    # 写入配置和重建用户数据库期间持有配置锁
+    with ConfigLock():
+        # 保存配置文件 (校验通过后才替换)
+        try:
+            config_changed = save_json(config_file, config, validate=check_config)
+        except ConfigInvalidError as e:
+            print(e)
+            return
+        if config_changed:
+            print(f"配置文件已保存到 {config_file}")
+        else:
+            print("配置未变化，跳过写入")
     
-    # 保存密钥信息到单独文件方便查看
-    keys_file = cert_dir / "keys.json"
-    keys_info = {
-        "reality": {
-            "private_key": private_key,
-            "public_key": public_key,
-            "short_id": short_id
+        # 保存密钥信息到单独文件方便查看
+        keys_file = cert_dir / "keys.json"
+        keys_info = {
+            "reality": {
+                "private_key": private_key,
+                "public_key": public_key,
+                "short_id": short_id
+            }
         }
-    }
     
-    with open(keys_file, 'w') as f:
-        json.dump(keys_info, f, indent=4)
+        if save_json(keys_file, keys_info):
+            print(f"密钥信息已保存到 {keys_file}")
     
-    print(f"密钥信息已保存到 {keys_file}")
+        # 以新配置重建用户数据库
+        conn = open_user_db()
+        try:
+            import_users_from_config(conn, config, replace=True)
+            with conn:
+                set_db_meta(conn, "rendered_revision", get_db_meta(conn, "revision"))
+            save_json(Path("/etc/sing-box/node_names.json"), {})
+        finally:
+            conn.close()
     
     # 开放防火墙端口
-    manage_ufw_port(vless_port)
-    manage_ufw_port(hy2_port)
+    reconcile_firewall(config)
     
     # 重启服务
-    restart_service()
+    if config_changed:
+        if load_shard_count() > 1:
+            apply_config_change(None, config)
+        else:
+            restart_service()
     
     # 生成连接URL
     server_ip = get_server_ip()
@@ -595,59 +2143,119 @@ def config_singbox():
     display_terminal_qrcode(hy2_url)
     generate_qrcode_image(hy2_url, username, "Hysteria2")
 
-# 列出用户
-def list_users():
-    config_file = Path("/etc/sing-box/config.json")
-    if not config_file.exists():
-        print("配置文件不存在")
-        return
-        
-    # 读取配置
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+# 显示一页用户 (只为当前页生成链接)
+def print_user_page(rows, total, page, page_size, context):
+    total_pages = max(1, (total + page_size - 1) // page_size)
+    start = (page - 1) * page_size
     
-    users_info = get_users_from_config(config)
+    print(f"\n=== 用户列表 (第 {page}/{total_pages} 页，共 {total} 个用户) ===")
+    for number, row in enumerate(rows, start + 1):
+        node_name = row["node_name"] or row["name"]
+        info = build_user_links(db_user_entry(row, context["vless"], context["hysteria2"]), node_name,
+                                context["server_ip"], context["reality_pubkey"], context["params_cache"])
+        print(f"\n{number}. 用户名: {row['name']}" + (f"  节点名称: {node_name}" if node_name != row["name"] else ""))
+        if "vless_url" in info:
+            print(f"VLESS链接: {info['vless_url']}")
+        if "hysteria2_url" in info:
+            print(f"Hysteria2链接: {info['hysteria2_url']}")
+    return total_pages
+
+# 显示单个用户的二维码
+def show_user_qrcode(row, context):
+    info = build_user_links(db_user_entry(row, context["vless"], context["hysteria2"]), row["node_name"] or row["name"],
+                            context["server_ip"], context["reality_pubkey"], context["params_cache"])
+    urls = [info[key] for key in ("vless_url", "hysteria2_url") if key in info]
+    qrcode_files = generate_qrcode_images(urls)
     
-    if not users_info:
-        print("未找到用户信息")
-        return
+    print(f"\n=== {row['name']} 的二维码 ===")
+    for key, label in (("vless_url", "VLESS"), ("hysteria2_url", "Hysteria2")):
+        if key in info:
+            print(f"\n{label}链接: {info[key]}")
+            display_terminal_qrcode(info[key])
+            if info[key] in qrcode_files:
+                print(f"二维码图片: {qrcode_files[info[key]]}")
+
+# 生成链接所需的公共参数 (同一次操作内共享)
+def get_link_context(config):
+    index = build_user_index(config)
+    return {
+        "vless": index["vless"],
+        "hysteria2": index["hysteria2"],
+        "server_ip": get_server_ip(),
+        "reality_pubkey": load_reality_pubkey(),
+        "params_cache": {}
+    }
+
+# 列出用户 (分页、过滤，二维码只为选中的用户生成)
+def list_users(pattern=None, regex=False, sort=None, page=1, page_size=LIST_PAGE_SIZE, interactive=True):
+    config = load_config()
+    if not config:
+        return False
     
-    print("\n=== 用户列表 ===")
-    for username, info in users_info.items():
-        print(f"\n用户名: {username}")
+    if interactive:
+        pattern = input("请输入过滤关键字 (匹配用户名或节点名称，以re:开头使用正则，留空显示全部): ").strip()
+        if pattern.startswith("re:"):
+            pattern, regex = pattern[3:], True
+        sort_choice = input("排序方式: 1.添加顺序 2.用户名 3.节点名称 (默认1): ").strip()
+        sort = {"2": "name", "3": "node"}.get(sort_choice, "config")
+    
+    if pattern and regex:
+        try:
+            compile_user_regex(pattern)
+        except re.error as e:
+            print(f"无效的正则表达式: {e}")
+            return False
+    
+    conn = open_user_db()
+    try:
+        total, _ = db_query_users(conn, pattern, regex, sort or "config", limit=0)
+        if not total:
+            print("未找到用户信息")
+            return False
         
-        if "vless_url" in info:
-            print(f"VLESS链接: {info['vless_url']}")
-            display_terminal_qrcode(info['vless_url'])
-            generate_qrcode_image(info['vless_url'], username, "VLESS")
+        # 同一次列表共享服务器IP、公钥及入站参数
+        context = get_link_context(config)
+        total_pages = max(1, (total + page_size - 1) // page_size)
+        page = min(max(page, 1), total_pages)
         
-        if "hysteria2_url" in info:
-            print(f"\nHysteria2链接: {info['hysteria2_url']}")
-            display_terminal_qrcode(info['hysteria2_url'])
-            generate_qrcode_image(info['hysteria2_url'], username, "Hysteria2")
+        while True:
+            _, rows = db_query_users(conn, pattern, regex, sort or "config", page_size, (page - 1) * page_size)
+            print_user_page(rows, total, page, page_size, context)
+            if not interactive:
+                return True
+            
+            action = input("\nn 下一页, p 上一页, 输入编号显示二维码, q 返回: ").strip().lower()
+            if action == "n":
+                if page < total_pages:
+                    page += 1
+                else:
+                    print("已经是最后一页")
+            elif action == "p":
+                if page > 1:
+                    page -= 1
+                else:
+                    print("已经是第一页")
+            elif action.isdigit() and 1 <= int(action) <= total:
+                _, selected = db_query_users(conn, pattern, regex, sort or "config", 1, int(action) - 1)
+                show_user_qrcode(selected[0], context)
+                input("\n按Enter键继续...")
+            elif action in ("q", "0", ""):
+                return True
+            else:
+                print("无效选择")
+    finally:
+        conn.close()
 
 # 添加用户
 def add_user():
-    config_file = Path("/etc/sing-box/config.json")
-    if not config_file.exists():
-        print("配置文件不存在，请先配置sing-box")
+    config = load_config()
+    if not config:
+        print("请先配置sing-box")
         return
     
-    # 读取配置
-    with open(config_file, 'r') as f:
-        config = json.load(f)
-    
     # 检查配置格式
-    vless_inbound = None
-    hy2_inbound = None
-    
-    for inbound in config["inbounds"]:
-        if inbound.get("type") == "vless":
-            vless_inbound = inbound
-        elif inbound.get("type") == "hysteria2":
-            hy2_inbound = inbound
-    
-    if not vless_inbound or not hy2_inbound:
+    context = get_link_context(config)
+    if not context["vless"] or not context["hysteria2"]:
         print("现有配置无效，找不到VLESS或Hysteria2入站")
         return
     
@@ -657,141 +2265,1006 @@ def add_user():
         print("用户名不能为空")
         return
     
-    # 检查用户名是否已存在
-    for user in vless_inbound.get("users", []):
-        if user.get("name") == username:
+    conn = open_user_db()
+    try:
+        # 检查用户名是否已存在
+        if db_get_user(conn, username):
+            print("用户名已存在")
+            return
+        
+        # 获取节点名称
+        node_name = input("请输入节点名称 (默认与用户名相同): ").strip()
+        if not node_name:
+            node_name = username
+        
+        # 生成UUID和密码并写入数据库 (其他进程可能已同时添加同名用户)
+        def insert_user(conn):
+            if db_get_user(conn, username):
+                return False
+            conn.execute("INSERT INTO users (name, uuid, password, node_name, created_at) VALUES (?, ?, ?, ?, ?)",
+                         (username, db_new_uuid(conn), db_new_password(conn),
+                          node_name if node_name != username else None, int(time.time())))
+            return True
+        
+        if not run_user_transaction(conn, insert_user):
             print("用户名已存在")
             return
+        
+        print("用户添加成功，重载服务...")
+        apply_user_changes(conn)
+        row = db_get_user(conn, username)
+    finally:
+        conn.close()
     
-    # 生成UUID和密码
-    user_uuid = str(uuid.uuid4())
-    hy2_password = random_string(16)
+    # 生成连接URL
+    if not context["reality_pubkey"]:
+        print("警告: 找不到Reality公钥，生成的URL可能不正确")
+    info = build_user_links(db_user_entry(row, context["vless"], context["hysteria2"]), node_name,
+                            context["server_ip"], context["reality_pubkey"], context["params_cache"])
+    
+    # 显示连接信息
+    print("\n=== 连接信息 ===")
+    print(f"VLESS链接: {info['vless_url']}")
+    display_terminal_qrcode(info['vless_url'])
+    generate_qrcode_image(info['vless_url'], username, node_name + "_VLESS")
+    
+    print(f"\nHysteria2链接: {info['hysteria2_url']}")
+    display_terminal_qrcode(info['hysteria2_url'])
+    generate_qrcode_image(info['hysteria2_url'], username, node_name + "_Hysteria2")
+
+# 读取批量用户文件
+# CSV: 每行 "用户名,节点名称" (节点名称可省略)
+# JSONL: 每行 {"username": "...", "node_name": "..."}
+def read_bulk_users(input_file):
+    with open(input_file, 'r', encoding='utf-8-sig') as f:
+        is_jsonl = str(input_file).endswith((".jsonl", ".json"))
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if is_jsonl or line.startswith("{"):
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    print(f"第{line_no}行格式错误，已跳过")
+                    continue
+                username = str(item.get("username") or item.get("name") or "").strip()
+                node_name = str(item.get("node_name") or "").strip()
+            else:
+                row = next(csv.reader([line]))
+                username = row[0].strip()
+                node_name = row[1].strip() if len(row) > 1 else ""
+                if line_no == 1 and username.lower() in ("username", "name", "用户名"):
+                    continue
+            yield line_no, username, node_name or username
+
+# 批量添加用户 (一个事务写入数据库，只生成一次配置、只重载一次服务)
+def bulk_add_users(input_file, output_file=None):
+    config = load_config()
+    if not config:
+        print("请先配置sing-box")
+        return False
+    
+    context = get_link_context(config)
+    if not context["vless"] or not context["hysteria2"]:
+        print("现有配置无效，找不到VLESS或Hysteria2入站")
+        return False
+    
+    conn = open_user_db()
+    try:
+        try:
+            entries = list(read_bulk_users(input_file))
+        except OSError as e:
+            print(f"读取文件失败: {e}")
+            return False
+        
+        # 冲突重试时重新检查用户名，已被其他进程添加的用户会被跳过
+        added = []
+        now = int(time.time())
+        
+        def insert_users(conn):
+            added.clear()
+            for line_no, username, node_name in entries:
+                if not username:
+                    print(f"第{line_no}行用户名为空，已跳过")
+                    continue
+                if db_get_user(conn, username):
+                    print(f"第{line_no}行用户名 {username} 已存在，已跳过")
+                    continue
+                
+                user_uuid = db_new_uuid(conn)
+                hy2_password = db_new_password(conn)
+                conn.execute("INSERT INTO users (name, uuid, password, node_name, created_at) VALUES (?, ?, ?, ?, ?)",
+                             (username, user_uuid, hy2_password,
+                              node_name if node_name != username else None, now))
+                added.append((username, node_name, user_uuid, hy2_password))
+            return bool(added)
+        
+        run_user_transaction(conn, insert_users)
+        
+        if not added:
+            print("没有需要添加的用户")
+            return False
+        
+        print(f"已添加 {len(added)} 个用户，重载服务...")
+        apply_user_changes(conn)
+    finally:
+        conn.close()
+    
+    # 输出连接链接
+    out = open(output_file, 'w') if output_file else sys.stdout
+    try:
+        for username, node_name, user_uuid, hy2_password in added:
+            row = {"name": username, "uuid": user_uuid, "password": hy2_password, "flow": "xtls-rprx-vision"}
+            info = build_user_links(db_user_entry(row, context["vless"], context["hysteria2"]), node_name,
+                                    context["server_ip"], context["reality_pubkey"], context["params_cache"])
+            out.write(info["vless_url"] + "\n")
+            out.write(info["hysteria2_url"] + "\n")
+    finally:
+        if output_file:
+            out.close()
+            print(f"连接链接已保存到 {output_file}")
+    return True
+
+# 预编译各入站的链接模板: 共享的前后缀只生成一次，每个用户只需拼接凭据、端口和名称
+# 返回 {"vless": 模板, "hysteria2": 模板}，模板为 (协议前缀, "@服务器:", 基础端口, 查询串)
+def compile_link_templates(config, server_ip, reality_pubkey):
+    templates = {}
+    # 只需要入站参数，不建立用户索引
+    inbounds = {inbound.get("type"): inbound for inbound in config.get("inbounds", [])}
+    if "vless" in inbounds:
+        params = get_vless_inbound_params(inbounds["vless"], server_ip, reality_pubkey)
+        # VLESS查询串只有flow因用户而异，在拼接时按flow缓存
+        query = (f"&security=reality&sni={params['sni']}&fp={params['fp']}&pbk={params['pbk']}"
+                 f"&sid={params['sid']}&type=tcp&headerType=none&host={params['sni']}#")
+        templates["vless"] = ("vless://", f"@{server_ip}:", params["port"], query)
+    if "hysteria2" in inbounds:
+        params = get_hy2_inbound_params(inbounds["hysteria2"], server_ip)
+        insecure = "1" if params["insecure"] else "0"
+        query = (f"?sni={params['sni']}&alpn=h3,h2,http/1.1&obfs=salamander"
+                 f"&obfs-password=ZXCZ123%40%21&insecure={insecure}#")
+        templates["hysteria2"] = ("hysteria2://", f"@{server_ip}:", params["port"], query)
+    return templates
+
+# 按模板逐个生成用户链接，返回 (用户名, 节点名称, VLESS链接, Hysteria2链接) 迭代器
+def iter_user_links(conn, templates, shard_count=1):
+    vless = templates.get("vless")
+    hy2 = templates.get("hysteria2")
+    vless_queries = {}
+    
+    # 只含URL安全字符时无需编码 (生成的用户名和密码通常如此)
+    def quote(text):
+        return text if URL_SAFE_RE.match(text) else urllib.parse.quote(text)
+    
+    for name, user_uuid, password, flow, node_name in conn.execute(
+            "SELECT name, uuid, password, flow, node_name FROM users ORDER BY id"):
+        node_name = node_name or name
+        fragment = quote(node_name)
+        offset = shard_for_user(name, shard_count) if shard_count > 1 else 0
+        
+        vless_url = None
+        if vless and user_uuid:
+            query = vless_queries.get(flow)
+            if query is None:
+                query = vless_queries[flow] = f"?encryption=none&flow={flow}" + vless[3]
+            vless_url = f"{vless[0]}{user_uuid}{vless[1]}{vless[2] + offset}{query}{fragment}"
+        
+        hy2_url = None
+        if hy2 and password:
+            hy2_url = f"{hy2[0]}{quote(password)}{hy2[1]}{hy2[2] + offset}{hy2[3]}{fragment}"
+        
+        if vless_url or hy2_url:
+            yield name, node_name, vless_url, hy2_url
+
+# 流式base64编码 (按3字节对齐分块编码，输出与整体编码一致)
+class Base64Writer:
+    def __init__(self, out):
+        self.out = out
+        self.pending = b""
+    
+    def write(self, text):
+        data = self.pending + text.encode("utf-8")
+        cut = len(data) - len(data) % 3
+        self.pending = data[cut:]
+        self.out.write(base64.b64encode(data[:cut]).decode("ascii"))
+    
+    def close(self):
+        self.out.write(base64.b64encode(self.pending).decode("ascii") + "\n")
+        self.pending = b""
+
+# 导出所有用户链接 (plain: 每行一个链接; base64: 订阅格式; json: 按用户输出的JSON数组)
+def export_user_links(output_file=None, export_format="plain"):
+    config = load_config()
+    if not config:
+        return False
+    
+    templates = compile_link_templates(config, get_server_ip(), load_reality_pubkey())
+    if not templates:
+        print("现有配置无效，找不到VLESS或Hysteria2入站")
+        return False
+    
+    conn = open_user_db()
+    out = open(output_file, 'w') if output_file else sys.stdout
+    writer = Base64Writer(out) if export_format == "base64" else out
+    count = 0
+    try:
+        if export_format == "json":
+            out.write("[")
+        batch = []
+        for name, node_name, vless_url, hy2_url in iter_user_links(conn, templates, load_shard_count()):
+            if export_format == "json":
+                item = {"name": name, "node_name": node_name, "vless_url": vless_url, "hysteria2_url": hy2_url}
+                batch.append(("," if count else "") + "\n" + json.dumps(item, ensure_ascii=False))
+            else:
+                # base64格式中第一个链接之前不加换行，与订阅服务输出一致
+                for url in (vless_url, hy2_url):
+                    if url:
+                        batch.append(url + "\n" if export_format == "plain" else ("\n" if count or batch else "") + url)
+            count += 1
+            if len(batch) >= 1000:
+                writer.write("".join(batch))
+                batch = []
+        writer.write("".join(batch))
+        if export_format == "json":
+            out.write("\n]\n")
+        elif export_format == "base64":
+            writer.close()
+    finally:
+        conn.close()
+        if output_file:
+            out.close()
+            print(f"已导出 {count} 个用户的链接到 {output_file}")
+    return True
+
+# 生成所有用户的订阅内容 {订阅token(VLESS UUID): 预先编码好的HTTP响应}
+def build_subscription_feeds(config):
+    users_info = get_users_from_config(config, node_names=load_node_names())
+    feeds = {}
+    for username, info in users_info.items():
+        links = [info[key] for key in ("vless_url", "hysteria2_url") if key in info]
+        if not info.get("uuid") or not links:
+            continue
+        body = base64.b64encode("\n".join(links).encode("utf-8"))
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        headers = (
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"ETag: {etag}\r\n"
+            "Cache-Control: no-cache\r\n"
+        ).encode("ascii")
+        feeds[info["uuid"]] = {"etag": etag, "headers": headers, "body": body}
+    return feeds
+
+# 订阅相关文件的修改时间，用于判断是否需要重新生成
+def subscription_source_stamp(config_file):
+    stamp = []
+    for path in (config_file, Path("/etc/sing-box/node_names.json"), Path("/etc/sing-box/cert/keys.json"), SERVER_IP_FILE,
+                 SHARD_FILE):
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size, st.st_ino))
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+# 发送简单的HTTP响应
+def write_http_response(writer, status, keep_alive, extra=""):
+    writer.write((f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n{extra}"
+                  f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("ascii"))
+
+# 运行订阅服务 (订阅地址: http://服务器IP:端口/sub/<VLESS UUID>)
+async def serve_subscriptions(host=SUBSCRIPTION_HOST, port=SUBSCRIPTION_PORT, config_file="/etc/sing-box/config.json"):
+    import asyncio
+    config_file = Path(config_file)
+    state = {"stamp": None, "feeds": {}}
+    loop = asyncio.get_running_loop()
+    
+    # 配置文件变化时在线程中重新生成全部订阅内容
+    def rebuild():
+        stamp = subscription_source_stamp(config_file)
+        if stamp == state["stamp"]:
+            return
+        with open(config_file, 'r') as f:
+            config = json.load(f)
+        state["feeds"] = build_subscription_feeds(config)
+        state["stamp"] = stamp
+        print(f"订阅内容已更新，共 {len(state['feeds'])} 个用户")
+    
+    async def watch():
+        while True:
+            try:
+                await loop.run_in_executor(None, rebuild)
+            except Exception as e:
+                print(f"更新订阅内容失败: {e}")
+            await asyncio.sleep(SUBSCRIPTION_REFRESH_INTERVAL)
+    
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=SUBSCRIPTION_IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                
+                lines = head.decode("latin-1").split("\r\n")
+                parts = lines[0].split()
+                if len(parts) != 3:
+                    write_http_response(writer, "400 Bad Request", False)
+                    break
+                method, target, version = parts
+                headers = {}
+                for line in lines[1:]:
+                    name, sep, value = line.partition(":")
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" and (version == "HTTP/1.1" or connection == "keep-alive")
+                
+                path = urllib.parse.urlsplit(target).path
+                feed = state["feeds"].get(path[len("/sub/"):]) if path.startswith("/sub/") else None
+                if method not in ("GET", "HEAD"):
+                    write_http_response(writer, "405 Method Not Allowed", keep_alive, "Allow: GET, HEAD\r\n")
+                elif feed is None:
+                    write_http_response(writer, "404 Not Found", keep_alive)
+                elif feed["etag"] in [t.strip() for t in headers.get("if-none-match", "").split(",")]:
+                    write_http_response(writer, "304 Not Modified", keep_alive, f"ETag: {feed['etag']}\r\n")
+                else:
+                    writer.write(feed["headers"])
+                    writer.write(f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("ascii"))
+                    if method == "GET":
+                        writer.write(feed["body"])
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+    
+    await loop.run_in_executor(None, rebuild)
+    watcher = asyncio.create_task(watch())
+    server = await asyncio.start_server(handle, host, port)
+    print(f"订阅服务已启动: http://{get_server_ip()}:{port}/sub/<用户UUID> (按Ctrl+C退出)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+# 启动订阅服务
+def run_subscription_server(host=SUBSCRIPTION_HOST, port=SUBSCRIPTION_PORT):
+    import asyncio
+    if not Path("/etc/sing-box/config.json").exists():
+        print("配置文件不存在")
+        return False
+    try:
+        asyncio.run(serve_subscriptions(host, port))
+    except KeyboardInterrupt:
+        print("\n订阅服务已停止")
+    except OSError as e:
+        print(f"启动订阅服务失败: {e}")
+        return False
+    return True
+
+# 编码protobuf varint
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+# 解码protobuf消息为 [(字段号, 值)]，只支持varint和length-delimited字段
+def decode_protobuf(data):
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = decode_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = decode_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = decode_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError(f"不支持的protobuf字段类型: {wire_type}")
+        fields.append((field, value))
+    return fields
+
+# 解码protobuf varint
+def decode_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+# 通过sing-box的v2ray_api (gRPC) 查询用户流量计数 {用户名: [上行字节, 下行字节]}
+def query_v2ray_stats(address=TRAFFIC_API_ADDRESS, timeout=5):
+    import grpc
+    
+    # QueryStatsRequest{pattern = "user>>>", reset = false}
+    pattern = b"user>>>"
+    request = b"\x0a" + encode_varint(len(pattern)) + pattern
+    with grpc.insecure_channel(address) as channel:
+        query = channel.unary_unary("/v2ray.core.app.stats.command.StatsService/QueryStats")
+        response = query(request, timeout=timeout)
+    
+    # QueryStatsResponse{repeated Stat stat = 1}, Stat{string name = 1; int64 value = 2}
+    counters = {}
+    for field, stat in decode_protobuf(response):
+        if field != 1:
+            continue
+        name, value = "", 0
+        for stat_field, stat_value in decode_protobuf(stat):
+            if stat_field == 1:
+                name = stat_value.decode("utf-8")
+            elif stat_field == 2:
+                value = stat_value
+        parts = name.split(">>>")
+        if len(parts) == 4 and parts[0] == "user" and parts[2] == "traffic":
+            direction = 0 if parts[3] == "uplink" else 1
+            counters.setdefault(parts[1], [0, 0])[direction] = value
+    return counters
+
+# 同步流量统计的用户列表 (仅在已启用统计时)
+def sync_traffic_stats_users(config):
+    stats = config.get("experimental", {}).get("v2ray_api", {}).get("stats")
+    if not stats:
+        return
+    index = build_user_index(config)
+    stats["users"] = list(index["names"])
+    stats["inbounds"] = [i["tag"] for i in config.get("inbounds", [])
+                         if i.get("type") in ("vless", "hysteria2") and i.get("tag")]
+
+# 启用sing-box流量统计接口
+def enable_traffic_stats():
+    config = load_config()
+    if not config:
+        return False
+    
+    installed, version = check_singbox()
+    if installed and "with_v2ray_api" not in (version or ""):
+        print("当前sing-box未包含with_v2ray_api编译选项，无法启用流量统计")
+        return False
+    
+    def enable_api(config):
+        for inbound in config.get("inbounds", []):
+            if inbound.get("type") == "vless" and not inbound.get("tag"):
+                inbound["tag"] = "vless-in"
+        config.setdefault("experimental", {})["v2ray_api"] = {
+            "listen": TRAFFIC_API_ADDRESS,
+            "stats": {"enabled": True}
+        }
+        sync_traffic_stats_users(config)
+    
+    result = edit_config(enable_api)
+    if not result:
+        return False
+    old_hash, config = result
+    if old_hash != config_hash(config):
+        print(f"已启用流量统计接口: {TRAFFIC_API_ADDRESS}")
+    apply_config_change(old_hash, config)
+    return True
+
+# 查询所有实例 (含各分片) 的用户流量计数 {接口地址: {用户名: [上行, 下行]}}
+# 各分片分别重载、计数分别清零，因此不能合并后再计算增量
+def query_all_traffic_stats():
+    return {address: query_v2ray_stats(address)
+            for address in (shard_address(TRAFFIC_API_ADDRESS, shard) for shard in range(load_shard_count()))}
+
+# 读取流量记录的用户编号表
+def load_traffic_user_ids():
+    try:
+        with open(TRAFFIC_DIR / "users.json", 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+# 追加流量记录 (定长二进制记录: 时间戳, 用户编号, 上行, 下行)
+def append_traffic_records(path, records):
+    with open(path, 'ab') as f:
+        f.write(b"".join(TRAFFIC_RECORD.pack(*record) for record in records))
+
+# 读取某个时间之后的流量记录 (记录按时间追加，二分查找起点)
+def read_traffic_records(path, since=0):
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            count = size // TRAFFIC_RECORD.size
+            low, high = 0, count
+            while low < high:
+                mid = (low + high) // 2
+                f.seek(mid * TRAFFIC_RECORD.size)
+                if TRAFFIC_RECORD.unpack(f.read(TRAFFIC_RECORD.size))[0] < since:
+                    low = mid + 1
+                else:
+                    high = mid
+            f.seek(low * TRAFFIC_RECORD.size)
+            data = f.read((count - low) * TRAFFIC_RECORD.size)
+    except FileNotFoundError:
+        return []
+    return list(TRAFFIC_RECORD.iter_unpack(data))
+
+# 采集一次流量数据并写入本地存储
+def collect_traffic_once(fetch=None):
+    counters = (fetch or query_all_traffic_stats)()
+    now = int(time.time())
+    TRAFFIC_DIR.mkdir(parents=True, exist_ok=True)
+    
+    user_ids = load_traffic_user_ids()
+    try:
+        with open(TRAFFIC_DIR / "counters.json", 'r') as f:
+            last = json.load(f)
+        # 旧格式只记录了单实例的计数
+        if any(isinstance(value, list) for value in last.values()):
+            last = {TRAFFIC_API_ADDRESS: last}
+    except Exception:
+        last = {}
+    
+    # 按实例分别计算增量后再按用户累加
+    deltas = {}
+    for address, shard_counters in counters.items():
+        shard_last = last.get(address, {})
+        for username, (up, down) in shard_counters.items():
+            prev_up, prev_down = shard_last.get(username, (0, 0))
+            # 计数小于上次说明该实例已重启或重载，计数从零开始
+            total = deltas.setdefault(username, [0, 0])
+            total[0] += up - prev_up if up >= prev_up else up
+            total[1] += down - prev_down if down >= prev_down else down
+    
+    records = []
+    for username, (delta_up, delta_down) in deltas.items():
+        if delta_up or delta_down:
+            if username not in user_ids:
+                user_ids[username] = len(user_ids)
+            records.append((now, user_ids[username], delta_up, delta_down))
+    
+    if records:
+        save_json(TRAFFIC_DIR / "users.json", user_ids)
+        append_traffic_records(TRAFFIC_DIR / "raw.bin", records)
+    save_json(TRAFFIC_DIR / "counters.json", counters)
+    return len(records)
+
+# 将超过保留期的原始记录汇总为小时记录
+def rollup_traffic(now=None):
+    now = int(now or time.time())
+    cutoff = (now - TRAFFIC_RAW_RETENTION) // 3600 * 3600
+    raw_file = TRAFFIC_DIR / "raw.bin"
+    records = read_traffic_records(raw_file)
+    if not records or records[0][0] >= cutoff:
+        return 0
+    
+    buckets = {}
+    remaining = []
+    for ts, uid, up, down in records:
+        if ts < cutoff:
+            key = (ts // 3600 * 3600, uid)
+            total = buckets.setdefault(key, [0, 0])
+            total[0] += up
+            total[1] += down
+        else:
+            remaining.append((ts, uid, up, down))
+    
+    append_traffic_records(TRAFFIC_DIR / "hourly.bin",
+                           [(ts, uid, up, down) for (ts, uid), (up, down) in sorted(buckets.items())])
+    
+    # 原子替换原始记录文件
+    tmp_file = raw_file.with_suffix(".tmp")
+    with open(tmp_file, 'wb') as f:
+        f.write(b"".join(TRAFFIC_RECORD.pack(*record) for record in remaining))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, raw_file)
+    return len(records) - len(remaining)
+
+# 统计时间窗口内流量最多的用户 [(用户名, 上行, 下行)]
+def traffic_top(window, limit=10, now=None):
+    now = int(now or time.time())
+    since = now - window
+    totals = {}
+    sources = [TRAFFIC_DIR / "raw.bin"]
+    if window > TRAFFIC_RAW_RETENTION:
+        sources.append(TRAFFIC_DIR / "hourly.bin")
+    for path in sources:
+        for ts, uid, up, down in read_traffic_records(path, since):
+            total = totals.setdefault(uid, [0, 0])
+            total[0] += up
+            total[1] += down
+    
+    names = {uid: name for name, uid in load_traffic_user_ids().items()}
+    ranked = sorted(totals.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)
+    return [(names.get(uid, str(uid)), up, down) for uid, (up, down) in ranked[:limit]]
+
+# 格式化字节数
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1024 or unit == "TB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+# 解析时间窗口，如 "30m"、"1h"、"1d"
+def parse_duration(text):
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+# 显示流量排行
+def print_traffic_top(window="1h", limit=10):
+    try:
+        seconds = parse_duration(window)
+    except ValueError:
+        print("无效的时间窗口")
+        return False
+    
+    ranking = traffic_top(seconds, limit)
+    print(f"\n=== 最近 {window} 流量排行 ===")
+    if not ranking:
+        print("暂无流量数据")
+        return True
+    print(f"{'用户名':<20}{'上行':>12}{'下行':>12}{'合计':>12}")
+    for username, up, down in ranking:
+        print(f"{username:<20}{format_bytes(up):>12}{format_bytes(down):>12}{format_bytes(up + down):>12}")
+    return True
+
+# 持续采集流量数据
+def run_traffic_collector(interval=60, once=False):
+    last_rollup = 0
+    while True:
+        try:
+            count = collect_traffic_once()
+            if once:
+                print(f"已采集 {count} 条流量记录")
+                return True
+        except ImportError:
+            print("缺少grpcio库，请先安装: pip install --break-system-packages grpcio")
+            return False
+        except Exception as e:
+            print(f"采集流量数据失败: {e}")
+            if once:
+                return False
+        
+        if time.time() - last_rollup > 3600:
+            rollup_traffic()
+            last_rollup = time.time()
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            print("\n已停止流量采集")
+            return True
+
+# 读取日志分析状态
+def load_log_stats():
+    try:
+        with open(LOG_STATS_FILE, 'r') as f:
+            state = json.load(f)
+        if isinstance(state.get("buckets"), dict):
+            return state
+    except (OSError, ValueError):
+        pass
+    return {"cursor": None, "buckets": {}}
+
+# 解析一行sing-box日志，返回 (入站, 用户名, 是否为连接, 是否为错误)，无关的行返回None
+def parse_singbox_log_line(message):
+    match = LOG_LINE_RE.search(ANSI_ESCAPE_RE.sub("", message))
+    if not match:
+        return None
+    text = match.group("text")
+    inbound = match.group("tag") or match.group("type")
+    is_connection = text.startswith(("inbound connection", "inbound packet connection"))
+    is_error = match.group("level") in ("ERROR", "FATAL", "PANIC") or text.startswith("process connection")
+    if not is_connection and not is_error:
+        return None
+    return inbound, match.group("user"), is_connection, is_error
+
+# 流式读取journald中的sing-box日志 (包括各分片)，返回 (时间戳, 消息, 游标) 迭代器
+def read_journal_entries(cursor=None, since=None):
+    cmd = ["journalctl", "-u", "sing-box", "-u", "sing-box@*", "--no-pager", "-o", "json",
+           "--output-fields=MESSAGE"]
+    if cursor:
+        cmd.append(f"--after-cursor={cursor}")
+    elif since:
+        cmd.append(f"--since=@{int(since)}")
     
-    # 获取节点名称
-    node_name = input("请输入节点名称 (默认与用户名相同): ").strip()
-    if not node_name:
-        node_name = username
+    # 流式读取不经过subprocess.run，单独记录跟踪事件
+    start = time.perf_counter()
+    size = 0
+    count = 0
+    with tempfile.TemporaryFile('w+') as stderr, \
+            subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, text=True) as proc:
+        for line in proc.stdout:
+            size += len(line)
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            message = entry.get("MESSAGE")
+            # 含非UTF-8内容的消息以字节数组形式输出
+            if isinstance(message, list):
+                message = bytes(message).decode("utf-8", "replace")
+            if isinstance(message, str):
+                count += 1
+                yield int(entry.get("__REALTIME_TIMESTAMP", 0)) // 1000000, message, entry.get("__CURSOR")
+        proc.wait()
+        stderr.seek(0)
+        error = stderr.read().strip()
+    if _trace_state["enabled"]:
+        record_trace_event("subprocess", "journalctl", start, time.perf_counter() - start,
+                           proc.returncode, size, " ".join(cmd))
     
-    # 添加到VLESS配置
-    new_vless_user = {
-        "name": username,
-        "uuid": user_uuid,
-        "flow": "xtls-rprx-vision"
-    }
-    vless_inbound["users"].append(new_vless_user)
+    # 游标失效等错误时报告，并改为按时间读取
+    if proc.returncode != 0:
+        print(f"读取日志失败 (返回码 {proc.returncode}): {error or '无错误输出'}")
+        if cursor and not count:
+            print("日志游标无效，改为按时间读取")
+            yield from read_journal_entries(since=since)
+
+# 读取上次游标之后的新日志并累加到按时间段汇总的统计中，返回新处理的行数
+def update_log_stats(state, now=None):
+    now = int(now or time.time())
+    buckets = state["buckets"]
+    count = 0
+    for timestamp, message, cursor in read_journal_entries(state.get("cursor"), now - LOG_INITIAL_WINDOW):
+        if cursor:
+            state["cursor"] = cursor
+        count += 1
+        parsed = parse_singbox_log_line(message)
+        if not parsed:
+            continue
+        inbound, username, is_connection, is_error = parsed
+        bucket = buckets.setdefault(str(timestamp - timestamp % LOG_BUCKET_SECONDS), {"inbounds": {}, "users": {}})
+        targets = [bucket["inbounds"].setdefault(inbound, [0, 0])]
+        if username:
+            targets.append(bucket["users"].setdefault(username, [0, 0]))
+        for counters in targets:
+            counters[0] += is_connection
+            counters[1] += is_error
     
-    # 添加到Hysteria2配置
-    new_hy2_user = {
-        "name": username,
-        "password": hy2_password
-    }
-    hy2_inbound["users"].append(new_hy2_user)
+    # 清理过期的时间段
+    cutoff = now - LOG_STATS_RETENTION
+    for key in [key for key in buckets if int(key) < cutoff]:
+        del buckets[key]
+    return count
+
+# 汇总时间窗口内的统计，返回 (入站统计, 用户统计)，值为 [连接数, 错误数]
+def aggregate_log_stats(state, since, until=None):
+    inbounds, users = {}, {}
+    for key, bucket in state["buckets"].items():
+        start = int(key)
+        if start + LOG_BUCKET_SECONDS <= since or (until is not None and start >= until):
+            continue
+        for target, source in ((inbounds, bucket["inbounds"]), (users, bucket["users"])):
+            for name, (connections, errors) in source.items():
+                total = target.setdefault(name, [0, 0])
+                total[0] += connections
+                total[1] += errors
+    return inbounds, users
+
+# 日志分析: 增量读取新日志后按入站和用户输出连接数与错误数
+def analyze_singbox_logs(window="1d", limit=10, username=None, reset=False):
+    try:
+        seconds = parse_duration(window)
+    except ValueError:
+        print("无效的时间窗口")
+        return False
     
-    # 保存配置
-    with open(config_file, 'w') as f:
-        json.dump(config, f, indent=4)
+    state = {"cursor": None, "buckets": {}} if reset else load_log_stats()
+    start = time.monotonic()
+    try:
+        count = update_log_stats(state)
+    except OSError as e:
+        print(f"读取日志失败: {e}")
+        return False
+    save_json(LOG_STATS_FILE, state)
+    print(f"已读取 {count} 条新日志 (耗时 {(time.monotonic() - start) * 1000:.0f} ms)")
     
-    print("用户添加成功，重启服务...")
-    restart_service()
+    inbounds, users = aggregate_log_stats(state, int(time.time()) - seconds)
+    if username:
+        users = {username: users.get(username, [0, 0])}
     
-    # 生成连接URL
-    server_ip = get_server_ip()
+    print(f"\n=== 最近 {window} 入站统计 ===")
+    if not inbounds:
+        print("暂无连接记录")
+    for name, (connections, errors) in sorted(inbounds.items(), key=lambda kv: kv[1], reverse=True):
+        print(f"{name:<20} 连接 {connections:>8}  错误 {errors:>6}")
     
-    # 获取Reality参数
-    reality_pubkey = ""
-    short_id = ""
-    server_name = "www.speedtest.net"
+    print(f"\n=== 最近 {window} 用户连接排行 ===")
+    ranking = sorted(users.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+    if not ranking:
+        print("暂无用户记录")
+    for name, (connections, errors) in ranking:
+        print(f"{name:<20} 连接 {connections:>8}  错误 {errors:>6}")
+    return True
+
+# 列出需要检查的端口 (分片模式下包含每个分片的端口)
+def get_health_targets(config, host):
+    targets = []
+    shard_count = load_shard_count()
+    for inbound in config.get("inbounds", []):
+        port = inbound.get("listen_port")
+        if not port:
+            continue
+        for shard in range(shard_count):
+            targets.append({"inbound": inbound.get("tag") or inbound.get("type"), "host": host,
+                            "port": int(port) + shard, "config": inbound})
+    return targets
+
+# TCP连接并完成TLS握手 (Reality入站会转发到握手服务器，因此不校验证书)
+async def probe_tcp(host, port, sni=None, timeout=HEALTH_TIMEOUT):
+    import asyncio
+    import ssl
+    context = None
+    if sni:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    _, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port, ssl=context, server_hostname=sni if context else None), timeout)
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (OSError, ssl.SSLError):
+        pass
+
+# salamander混淆: 8字节盐 + 以BLAKE2b(密码+盐)为密钥流异或的数据
+def salamander_xor(password, salt, data):
+    key = hashlib.blake2b(password.encode("utf-8") + salt, digest_size=32).digest()
+    stream = (key * (len(data) // len(key) + 1))[:len(data)]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(stream, "big")).to_bytes(len(data), "big")
+
+# 发送未知版本的QUIC Initial包，服务端回复版本协商包即说明端口在监听
+async def probe_quic(host, port, obfs_password=None, timeout=HEALTH_TIMEOUT):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    received = loop.create_future()
     
-    if "tls" in vless_inbound and "reality" in vless_inbound["tls"]:
-        reality = vless_inbound["tls"]["reality"]
-        server_name = vless_inbound["tls"].get("server_name", server_name)
+    class ProbeProtocol(asyncio.DatagramProtocol):
+        def datagram_received(self, data, addr):
+            if not received.done():
+                received.set_result(data)
         
-        # 读取公钥
-        keys_file = Path("/etc/sing-box/cert/keys.json")
-        if keys_file.exists():
-            with open(keys_file, 'r') as f:
-                keys = json.load(f)
-                reality_pubkey = keys.get("reality", {}).get("public_key", "")
-        
-        if not reality_pubkey:
-            print("警告: 找不到Reality公钥，生成的URL可能不正确")
-        
-        short_id = reality.get("short_id", [""])[0] if isinstance(reality.get("short_id"), list) else reality.get("short_id", "")
-        
-    vless_url = generate_vless_url({
-        "uuid": user_uuid,
-        "server_ip": server_ip,
-        "port": vless_inbound.get("listen_port"),
-        "sni": server_name,
-        "fp": "chrome",
-        "pbk": reality_pubkey,
-        "sid": short_id
-    }, node_name)
+        def error_received(self, exc):
+            if not received.done():
+                received.set_exception(exc)
     
-    hy2_insecure = True
-    if "tls" in hy2_inbound:
-        hy2_insecure = hy2_inbound["tls"].get("insecure", True)
-        server_name = hy2_inbound["tls"].get("server_name", server_name)
+    dcid = secrets.token_bytes(8)
+    packet = bytes([0xC0 | secrets.randbelow(4)]) + QUIC_PROBE_VERSION.to_bytes(4, "big")
+    packet += bytes([len(dcid)]) + dcid + bytes([8]) + secrets.token_bytes(8)
+    # 客户端Initial包至少1200字节，否则服务端不会回复
+    packet = packet.ljust(1200, b"\x00")
+    if obfs_password:
+        salt = secrets.token_bytes(8)
+        packet = salt + salamander_xor(obfs_password, salt, packet)
     
-    hy2_url = generate_hysteria2_url({
-        "password": hy2_password,
-        "server_ip": server_ip,
-        "port": hy2_inbound.get("listen_port"),
-        "sni": server_name,
-        "insecure": hy2_insecure
-    }, node_name)
+    transport, _ = await loop.create_datagram_endpoint(ProbeProtocol, remote_addr=(host, port))
+    try:
+        transport.sendto(packet)
+        data = await asyncio.wait_for(received, timeout)
+    finally:
+        transport.close()
     
-    # 显示连接信息
-    print("\n=== 连接信息 ===")
-    print(f"VLESS链接: {vless_url}")
-    display_terminal_qrcode(vless_url)
-    generate_qrcode_image(vless_url, username, node_name + "_VLESS")
+    if obfs_password:
+        data = salamander_xor(obfs_password, data[:8], data[8:])
+    # 版本协商包: 长包头且版本号为0
+    if len(data) < 5 or not data[0] & 0x80 or data[1:5] != b"\x00\x00\x00\x00":
+        raise ConnectionError("收到的不是QUIC版本协商包")
+
+# 按入站类型探测一个端口，返回 (是否成功, 耗时秒数, 错误信息)
+async def probe_target(target, semaphore, timeout=HEALTH_TIMEOUT):
+    import asyncio
+    import ssl
+    inbound = target["config"]
+    tls = inbound.get("tls", {})
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            if inbound.get("type") in ("hysteria2", "tuic"):
+                obfs = inbound.get("obfs") or {}
+                await probe_quic(target["host"], target["port"],
+                                 obfs.get("password") if obfs.get("type") == "salamander" else None, timeout)
+            else:
+                sni = None
+                if tls.get("enabled"):
+                    sni = tls.get("server_name") or tls.get("reality", {}).get("handshake", {}).get("server")
+                await probe_tcp(target["host"], target["port"], sni, timeout)
+            return True, time.perf_counter() - start, None
+        except asyncio.TimeoutError:
+            return False, time.perf_counter() - start, "超时"
+        except (OSError, ssl.SSLError, ConnectionError) as e:
+            return False, time.perf_counter() - start, str(e) or type(e).__name__
+
+# 计算百分位数 (最近秩法)
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(len(ordered) * fraction + 0.999999) - 1))]
+
+# 并发探测所有端口，按入站汇总 {入站: {"ok", "total", "latencies", "errors": {端口: 错误}}}
+async def check_inbounds(targets, count=1, timeout=HEALTH_TIMEOUT):
+    import asyncio
+    semaphore = asyncio.Semaphore(HEALTH_CONCURRENCY)
+    probes = [target for target in targets for _ in range(count)]
+    results = await asyncio.gather(*(probe_target(target, semaphore, timeout) for target in probes))
     
-    print(f"\nHysteria2链接: {hy2_url}")
-    display_terminal_qrcode(hy2_url)
-    generate_qrcode_image(hy2_url, username, node_name + "_Hysteria2")
+    summary = {}
+    for target, (ok, latency, error) in zip(probes, results):
+        item = summary.setdefault(target["inbound"], {"ok": 0, "total": 0, "latencies": [], "errors": {}})
+        item["total"] += 1
+        if ok:
+            item["ok"] += 1
+            item["latencies"].append(latency)
+        else:
+            item["errors"][target["port"]] = error
+    return summary
+
+# 输出健康检查结果，全部成功时返回True
+def print_health_summary(summary, elapsed):
+    print(f"\n=== 入站健康检查 ({time.strftime('%H:%M:%S')}, 耗时 {elapsed * 1000:.0f} ms) ===")
+    print(f"{'入站':<16}{'成功/总数':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    healthy = True
+    for name, item in summary.items():
+        latencies = item["latencies"]
+        columns = [f"{percentile(latencies, q) * 1000:>10.1f}" for q in (0.5, 0.9, 0.99)] if latencies else [f"{'-':>10}"] * 3
+        print(f"{name:<16}{item['ok']:>5}/{item['total']:<4}" + "".join(columns))
+        for port, error in sorted(item["errors"].items()):
+            print(f"  端口 {port}: {error}")
+        healthy = healthy and item["ok"] == item["total"]
+    return healthy
+
+# 健康检查: watch大于0时每隔watch秒重复检查
+def run_health_check(host="127.0.0.1", count=1, timeout=HEALTH_TIMEOUT, watch=0):
+    import asyncio
+    config = load_config()
+    if not config:
+        return False
+    targets = get_health_targets(config, host)
+    if not targets:
+        print("配置中没有入站端口")
+        return False
+    
+    while True:
+        start = time.monotonic()
+        summary = asyncio.run(check_inbounds(targets, count, timeout))
+        healthy = print_health_summary(summary, time.monotonic() - start)
+        if watch <= 0:
+            return healthy
+        try:
+            time.sleep(watch)
+        except KeyboardInterrupt:
+            print("\n已停止健康检查")
+            return healthy
 
 # 删除用户
 def delete_user():
-    config_file = Path("/etc/sing-box/config.json")
-    if not config_file.exists():
+    if not Path("/etc/sing-box/config.json").exists():
         print("配置文件不存在")
         return
-        
-    # 读取配置
-    with open(config_file, 'r') as f:
-        config = json.load(f)
-    
-    # 查找入站
-    vless_inbound = None
-    hy2_inbound = None
     
-    for inbound in config["inbounds"]:
-        if inbound.get("type") == "vless":
-            vless_inbound = inbound
-        elif inbound.get("type") == "hysteria2":
-            hy2_inbound = inbound
-    
-    if not vless_inbound or not hy2_inbound:
-        print("现有配置无效")
-        return
-        
-    # 获取用户列表
-    users = []
-    for user in vless_inbound.get("users", []):
-        if "name" in user:
-            users.append(user["name"])
-    
-    if not users:
-        print("没有找到用户")
-        return
-        
-    print("\n=== 用户列表 ===")
-    for i, username in enumerate(users, 1):
-        print(f"{i}. {username}")
-        
-    # 选择用户
+    conn = open_user_db()
     try:
+        # 获取用户列表
+        users = [row["name"] for row in conn.execute("SELECT name FROM users ORDER BY id")]
+        
+        if not users:
+            print("没有找到用户")
+            return
+            
+        print("\n=== 用户列表 ===")
+        for i, username in enumerate(users, 1):
+            print(f"{i}. {username}")
+            
+        # 选择用户
         choice = int(input("\n请选择要删除的用户编号 (0返回): "))
         if choice == 0:
             return
@@ -807,62 +3280,76 @@ def delete_user():
             print("操作已取消")
             return
             
-        # 删除VLESS用户
-        vless_inbound["users"] = [u for u in vless_inbound.get("users", []) if u.get("name") != target_user]
-        
-        # 删除Hysteria2用户
-        hy2_inbound["users"] = [u for u in hy2_inbound.get("users", []) if u.get("name") != target_user]
-        
-        # 保存配置
-        with open(config_file, 'w') as f:
-            json.dump(config, f, indent=4)
+        # 删除用户 (VLESS和Hysteria2入站中的用户在生成配置时一并删除)
+        if not run_user_transaction(conn, lambda conn: conn.execute("DELETE FROM users WHERE name = ?",
+                                                                     (target_user,)).rowcount):
+            print(f"用户 {target_user} 已被其他操作删除")
+            return
             
         print(f"用户 {target_user} 已删除")
         
-        # 检查是否需要关闭端口
-        if not vless_inbound["users"]:
-            # 没有用户了，可以关闭端口
-            manage_ufw_port(vless_inbound["listen_port"], "delete")
-        
-        if not hy2_inbound["users"]:
-            # 没有用户了，可以关闭端口
-            manage_ufw_port(hy2_inbound["listen_port"], "delete")
+        # 生成配置并重载服务
+        apply_user_changes(conn)
         
-        # 重启服务
-        restart_service()
+        # 同步防火墙端口 (没有用户的入站会关闭端口)
+        config = load_config()
+        if config:
+            reconcile_firewall(config)
         
     except ValueError:
         print("请输入有效的数字")
     except Exception as e:
         print(f"操作失败: {e}")
+    finally:
+        conn.close()
+
+# 显示修改后的用户链接
+def show_modified_user_links(conn, username, keys, label_suffix=""):
+    config = load_config()
+    if not config:
+        return
+    context = get_link_context(config)
+    row = db_get_user(conn, username)
+    node_name = row["node_name"] or username
+    info = build_user_links(db_user_entry(row, context["vless"], context["hysteria2"]), node_name,
+                            context["server_ip"], context["reality_pubkey"], context["params_cache"])
+    for key, label in (("vless_url", "VLESS"), ("hysteria2_url", "Hysteria2")):
+        if key in keys and key in info:
+            print(f"\n{label}链接: {info[key]}")
+            display_terminal_qrcode(info[key])
+            generate_qrcode_image(info[key], username, label_suffix + label)
+
+# 修改用户的单个字段，用户已被其他操作删除时返回False
+def update_user_field(conn, username, column, value):
+    if run_user_transaction(conn, lambda conn: conn.execute(f"UPDATE users SET {column} = ? WHERE name = ?",
+                                                            (value, username)).rowcount):
+        return True
+    print(f"用户 {username} 已被其他操作删除")
+    return False
 
 # 修改用户信息
 def modify_user():
-    config_file = Path("/etc/sing-box/config.json")
-    if not config_file.exists():
+    if not Path("/etc/sing-box/config.json").exists():
         print("配置文件不存在")
         return
-        
-    # 读取配置
-    with open(config_file, 'r') as f:
-        config = json.load(f)
-    
-    users_info = get_users_from_config(config)
-    if not users_info:
-        print("未找到用户信息")
-        return
-        
-    print("\n=== 现有用户列表 ===")
-    for idx, (username, info) in enumerate(users_info.items(), 1):
-        print(f"{idx}. {username}")
     
+    conn = open_user_db()
     try:
+        usernames = [row["name"] for row in conn.execute("SELECT name FROM users ORDER BY id")]
+        if not usernames:
+            print("未找到用户信息")
+            return
+            
+        print("\n=== 现有用户列表 ===")
+        for idx, username in enumerate(usernames, 1):
+            print(f"{idx}. {username}")
+        
         user_idx = int(input("\n请选择要修改的用户编号: ").strip()) - 1
-        if user_idx < 0 or user_idx >= len(users_info):
+        if user_idx < 0 or user_idx >= len(usernames):
             print("无效的用户编号")
             return
             
-        selected_username = list(users_info.keys())[user_idx]
+        selected_username = usernames[user_idx]
         
         print(f"\n=== 修改用户: {selected_username} ===")
         print("1. 修改UUID")
@@ -873,65 +3360,41 @@ def modify_user():
         mod_choice = input("\n请选择要修改的信息 [0-3]: ").strip()
         
         if mod_choice == "1":
-            new_uuid = str(uuid.uuid4())
+            new_uuid = db_new_uuid(conn)
             print(f"新UUID: {new_uuid}")
             if input("确认修改? (y/n): ").lower() == 'y':
                 # 更新VLESS用户的UUID
-                for inbound in config["inbounds"]:
-                    if inbound.get("type") == "vless":
-                        for user in inbound.get("users", []):
-                            if user.get("name") == selected_username:
-                                user["uuid"] = new_uuid
-                                break
-                
-                # 保存配置并重启服务
-                with open(config_file, 'w') as f:
-                    json.dump(config, f, indent=4)
+                if not update_user_field(conn, selected_username, "uuid", new_uuid):
+                    return
                     
                 print(f"用户{selected_username}的UUID已更新")
-                restart_service()
+                apply_user_changes(conn)
                 
-                # 更新并显示新链接
-                users_info = get_users_from_config(config)
+                # 显示新链接
                 print(f"\n新的连接信息:")
-                user_info = users_info.get(selected_username)
-                if user_info:
-                    if "vless_url" in user_info:
-                        print(f"VLESS链接: {user_info['vless_url']}")
-                        display_terminal_qrcode(user_info['vless_url'])
-                        generate_qrcode_image(user_info['vless_url'], selected_username, "VLESS")
+                show_modified_user_links(conn, selected_username, ("vless_url",))
                         
         elif mod_choice == "2":
             new_password = input("请输入新的Hysteria2密码 (留空将随机生成): ").strip()
             if not new_password:
-                new_password = random_string(16)
+                new_password = db_new_password(conn)
+            elif conn.execute("SELECT 1 FROM users WHERE password = ? AND name != ?",
+                              (new_password, selected_username)).fetchone():
+                print("该密码已被其他用户使用")
+                return
             print(f"新密码: {new_password}")
             
             if input("确认修改? (y/n): ").lower() == 'y':
                 # 更新Hysteria2用户密码
-                for inbound in config["inbounds"]:
-                    if inbound.get("type") == "hysteria2":
-                        for user in inbound.get("users", []):
-                            if user.get("name") == selected_username:
-                                user["password"] = new_password
-                                break
-                
-                # 保存配置并重启服务
-                with open(config_file, 'w') as f:
-                    json.dump(config, f, indent=4)
+                if not update_user_field(conn, selected_username, "password", new_password):
+                    return
                     
                 print(f"用户{selected_username}的Hysteria2密码已更新")
-                restart_service()
+                apply_user_changes(conn)
                 
-                # 更新并显示新链接
-                users_info = get_users_from_config(config)
+                # 显示新链接
                 print(f"\n新的连接信息:")
-                user_info = users_info.get(selected_username)
-                if user_info:
-                    if "hysteria2_url" in user_info:
-                        print(f"Hysteria2链接: {user_info['hysteria2_url']}")
-                        display_terminal_qrcode(user_info['hysteria2_url'])
-                        generate_qrcode_image(user_info['hysteria2_url'], selected_username, "Hysteria2")
+                show_modified_user_links(conn, selected_username, ("hysteria2_url",))
                         
         elif mod_choice == "3":
             new_name = input("请输入新的节点名称: ").strip()
@@ -939,98 +3402,15 @@ def modify_user():
                 print("节点名称不能为空")
                 return
                 
-            # 保存节点名称到配置的自定义字段
-            node_name_file = Path("/etc/sing-box/node_names.json")
-            node_names = {}
-            if node_name_file.exists():
-                try:
-                    with open(node_name_file, 'r') as f:
-                        node_names = json.load(f)
-                except:
-                    pass
-            
-            node_names[selected_username] = new_name
-            
-            with open(node_name_file, 'w') as f:
-                json.dump(node_names, f, indent=4)
+            # 保存节点名称
+            if not update_user_field(conn, selected_username, "node_name", new_name):
+                return
+            apply_user_changes(conn)
                 
             print(f"节点名称已更新为: {new_name}")
             
             # 重新生成链接
-            server_ip = get_server_ip()
-            reality_pubkey = ""
-            short_id = ""
-            
-            # 获取VLESS信息
-            vless_port = None
-            vless_uuid = None
-            vless_sni = "www.speedtest.net"
-            
-            # 获取Hysteria2信息
-            hy2_port = None
-            hy2_password = None
-            hy2_sni = "www.speedtest.net"
-            hy2_insecure = True
-            
-            # 从配置中读取信息
-            for inbound in config["inbounds"]:
-                if inbound.get("type") == "vless":
-                    for user in inbound.get("users", []):
-                        if user.get("name") == selected_username:
-                            vless_uuid = user.get("uuid")
-                            vless_port = inbound.get("listen_port")
-                            if "tls" in inbound:
-                                vless_sni = inbound["tls"].get("server_name", vless_sni)
-                                if "reality" in inbound["tls"]:
-                                    reality = inbound["tls"]["reality"]
-                                    short_id = reality.get("short_id", [""])[0] if isinstance(reality.get("short_id"), list) else reality.get("short_id", "")
-                                    
-                                    # 读取公钥
-                                    keys_file = Path("/etc/sing-box/cert/keys.json")
-                                    if keys_file.exists():
-                                        with open(keys_file, 'r') as f:
-                                            keys = json.load(f)
-                                            reality_pubkey = keys.get("reality", {}).get("public_key", "")
-                            break
-                
-                elif inbound.get("type") == "hysteria2":
-                    for user in inbound.get("users", []):
-                        if user.get("name") == selected_username:
-                            hy2_password = user.get("password")
-                            hy2_port = inbound.get("listen_port")
-                            if "tls" in inbound:
-                                hy2_sni = inbound["tls"].get("server_name", hy2_sni)
-                                hy2_insecure = inbound["tls"].get("insecure", hy2_insecure)
-                            break
-            
-            # 生成新链接
-            if vless_uuid and vless_port:
-                vless_url = generate_vless_url({
-                    "uuid": vless_uuid,
-                    "server_ip": server_ip,
-                    "port": vless_port,
-                    "sni": vless_sni,
-                    "fp": "chrome",
-                    "pbk": reality_pubkey,
-                    "sid": short_id
-                }, new_name)
-                
-                print(f"\nVLESS链接: {vless_url}")
-                display_terminal_qrcode(vless_url)
-                generate_qrcode_image(vless_url, selected_username, new_name + "_VLESS")
-            
-            if hy2_password and hy2_port:
-                hy2_url = generate_hysteria2_url({
-                    "password": hy2_password,
-                    "server_ip": server_ip,
-                    "port": hy2_port,
-                    "sni": hy2_sni,
-                    "insecure": hy2_insecure
-                }, new_name)
-                
-                print(f"\nHysteria2链接: {hy2_url}")
-                display_terminal_qrcode(hy2_url)
-                generate_qrcode_image(hy2_url, selected_username, new_name + "_Hysteria2")
+            show_modified_user_links(conn, selected_username, ("vless_url", "hysteria2_url"), new_name + "_")
                 
         elif mod_choice == "0":
             return
@@ -1041,75 +3421,28 @@ def modify_user():
         print("请输入有效的数字")
     except Exception as e:
         print(f"修改用户信息失败: {e}")
+    finally:
+        conn.close()
 
 # 更新用户URL信息
-def update_user_urls(config, users_info):
+def update_user_urls(config, users_info, index=None):
+    if index is None:
+        index = build_user_index(config)
     server_ip = get_server_ip()
     
     # 获取Reality公钥
-    reality_pubkey = ""
-    keys_file = Path("/etc/sing-box/cert/keys.json")
-    if keys_file.exists():
-        try:
-            with open(keys_file, 'r') as f:
-                keys = json.load(f)
-                reality_pubkey = keys.get("reality", {}).get("public_key", "")
-        except:
-            pass
+    reality_pubkey = load_reality_pubkey()
     
     # 获取节点名称
-    node_name_file = Path("/etc/sing-box/node_names.json")
-    node_names = {}
-    if node_name_file.exists():
-        try:
-            with open(node_name_file, 'r') as f:
-                node_names = json.load(f)
-        except:
-            pass
+    node_names = load_node_names()
     
     # 更新所有用户的URL
+    params_cache = {}
     for username, info in users_info.items():
-        # 获取节点名称
-        node_name = node_names.get(username, username)
-        
-        # 更新VLESS URL
-        for inbound in config["inbounds"]:
-            if inbound.get("type") == "vless":
-                for user in inbound.get("users", []):
-                    if user.get("name") == username:
-                        if "tls" in inbound and "reality" in inbound["tls"]:
-                            short_id = inbound["tls"]["reality"].get("short_id", [""])[0] if isinstance(inbound["tls"]["reality"].get("short_id"), list) else inbound["tls"]["reality"].get("short_id", "")
-                            sni = inbound["tls"].get("server_name", "www.speedtest.net")
-                            fp = inbound["tls"]["reality"].get("fingerprint", "chrome")
-                            
-                            vless_url = generate_vless_url({
-                                "uuid": user.get("uuid"),
-                                "server_ip": server_ip,
-                                "port": inbound.get("listen_port"),
-                                "sni": sni,
-                                "fp": fp,
-                                "pbk": reality_pubkey,
-                                "sid": short_id,
-                                "flow": user.get("flow", "xtls-rprx-vision")
-                            }, node_name)
-                            info["vless_url"] = vless_url
-        
-        # 更新Hysteria2 URL
-        for inbound in config["inbounds"]:
-            if inbound.get("type") == "hysteria2":
-                for user in inbound.get("users", []):
-                    if user.get("name") == username:
-                        sni = inbound.get("tls", {}).get("server_name", "www.speedtest.net")
-                        insecure = inbound.get("tls", {}).get("insecure", True)
-                        
-                        hy2_url = generate_hysteria2_url({
-                            "password": user.get("password"),
-                            "server_ip": server_ip,
-                            "port": inbound.get("listen_port"),
-                            "sni": sni,
-                            "insecure": insecure
-                        }, node_name)
-                        info["hysteria2_url"] = hy2_url
+        entry = index["names"].get(username)
+        if entry:
+            info.update(build_user_links(entry, node_names.get(username, username),
+                                         server_ip, reality_pubkey, params_cache))
 
 # 管理防火墙
 def manage_firewall():
@@ -1130,9 +3463,10 @@ def manage_firewall():
         print("2. 禁用防火墙")
         print("3. 打开端口")
         print("4. 关闭端口")
+        print("5. 按配置同步端口")
         print("0. 返回上级菜单")
         
-        choice = input("\n请选择操作 [0-4]: ").strip()
+        choice = input("\n请选择操作 [0-5]: ").strip()
         
         if choice == "1":
             if status == "active":
@@ -1170,6 +3504,11 @@ def manage_firewall():
             except ValueError:
                 print("请输入有效的端口号")
         
+        elif choice == "5":
+            config = load_config()
+            if config:
+                reconcile_firewall(config)
+        
         elif choice == "0":
             return
         
@@ -1194,6 +3533,9 @@ def manage_singbox():
             print("6. 实时查看日志")
             print("7. 更新 sing-box")
             print("8. 卸载 sing-box")
+            print("9. 重载 sing-box 配置")
+            print("10. 日志分析 (最近一天)")
+            print("11. 入站健康检查")
         else:
             print("sing-box 未安装")
             print("1. 安装 sing-box (稳定版)")
@@ -1209,15 +3551,18 @@ def manage_singbox():
             elif choice == "2":
                 view_singbox_logs()
             elif choice == "3":
-                start_service()
+                for service in singbox_services():
+                    start_service(service)
             elif choice == "4":
-                restart_service()
+                for service in singbox_services():
+                    restart_service(service)
             elif choice == "5":
-                stop_service()
+                for service in singbox_services():
+                    stop_service(service)
             elif choice == "6":
                 print("\n=== 实时日志 (按Ctrl+C退出) ===")
                 try:
-                    subprocess.run(["journalctl", "-u", "sing-box", "-f"], check=True)
+                    subprocess.run(["journalctl", "-u", "sing-box", "-u", "sing-box@*", "-f"], check=True)
                 except KeyboardInterrupt:
                     print("\n已退出日志查看")
                 except Exception as e:
@@ -1249,6 +3594,12 @@ def manage_singbox():
                 if uninstall_singbox():
                     installed = False
                     version = None
+            elif choice == "9":
+                reload_all_services()
+            elif choice == "10":
+                analyze_singbox_logs()
+            elif choice == "11":
+                run_health_check()
             elif choice == "0":
                 return
             else:
@@ -1275,7 +3626,7 @@ def manage_singbox():
 def view_singbox_status():
     print("\n=== sing-box 状态信息 ===")
     try:
-        result = subprocess.run(["systemctl", "status", "sing-box"], capture_output=True, text=True)
+        result = subprocess.run(["systemctl", "status", "--no-pager"] + singbox_services(), capture_output=True, text=True)
         print(result.stdout)
     except Exception as e:
         print(f"获取状态失败: {e}")
@@ -1283,7 +3634,7 @@ def view_singbox_status():
 def view_singbox_logs():
     print("\n=== sing-box 日志信息 ===")
     try:
-        result = subprocess.run(["journalctl", "-u", "sing-box", "--no-pager", "-n", "50"], 
+        result = subprocess.run(["journalctl", "-u", "sing-box", "-u", "sing-box@*", "--no-pager", "-n", "50"], 
                                capture_output=True, text=True)
         print(result.stdout)
     except Exception as e:
@@ -1302,9 +3653,11 @@ def manage_users():
         print("2. 添加新用户")
         print("3. 删除用户")
         print("4. 修改用户信息")
+        print("5. 批量导入用户")
+        print("6. 导出所有链接")
         print("0. 返回上级菜单")
         
-        choice = input("\n请选择操作 [0-4]: ").strip()
+        choice = input("\n请选择操作 [0-6]: ").strip()
         
         if choice == "1":
             list_users()
@@ -1314,6 +3667,14 @@ def manage_users():
             delete_user()
         elif choice == "4":
             modify_user()
+        elif choice == "5":
+            input_file = input("请输入用户文件路径 (CSV或JSONL): ").strip()
+            if input_file:
+                output_file = input("请输入链接输出文件路径 (留空输出到终端): ").strip()
+                bulk_add_users(input_file, output_file or None)
+        elif choice == "6":
+            output_file = input("请输入输出文件路径 (留空输出到终端): ").strip()
+            export_user_links(output_file or None)
         elif choice == "0":
             return
         else:
@@ -1321,18 +3682,659 @@ def manage_users():
         
         input("\n按Enter键继续...")
 
+# 生成包含指定用户数的测试配置
+def generate_bench_config(user_count):
+    names = [f"user{i:06d}" for i in range(user_count)]
+    return {
+        "inbounds": [
+            {
+                "type": "vless",
+                "listen": "::",
+                "listen_port": 18890,
+                "users": [{"name": name, "uuid": str(uuid.uuid4()), "flow": "xtls-rprx-vision"} for name in names],
+                "tls": {
+                    "enabled": True,
+                    "server_name": "www.speedtest.net",
+                    "reality": {
+                        "enabled": True,
+                        "handshake": {"server": "www.speedtest.net", "server_port": 443},
+                        "private_key": "bench",
+                        "short_id": ["0123456789abcdef"]
+                    }
+                }
+            },
+            {
+                "type": "hysteria2",
+                "listen": "::",
+                "listen_port": 443,
+                "users": [{"name": name, "password": secrets.token_hex(8)} for name in names],
+                "tls": {"enabled": True, "server_name": "www.speedtest.net", "alpn": ["h3"]}
+            }
+        ],
+        "outbounds": [{"type": "direct"}]
+    }
+
+# 基准测试期间替换外部调用 (子进程、服务器IP、/etc下的文件)
+class BenchStubs:
+    def __enter__(self):
+        module = globals()
+        self.saved = {name: module[name] for name in
+                      ("get_server_ip", "load_reality_pubkey", "load_node_names", "load_shard_count")}
+        self.saved_run = subprocess.run
+        module["get_server_ip"] = lambda refresh=False: "203.0.113.1"
+        module["load_reality_pubkey"] = lambda: "bench-public-key"
+        module["load_node_names"] = lambda: {}
+        module["load_shard_count"] = lambda: 1
+        subprocess.run = lambda cmd, *args, **kwargs: subprocess.CompletedProcess(cmd, 0, "", "")
+        return self
+    
+    def __exit__(self, *exc):
+        globals().update(self.saved)
+        subprocess.run = self.saved_run
+        return False
+
+# 测量一个操作: 多次运行取最短耗时，再单独运行一次记录内存峰值
+def measure_operation(func, repeat):
+    import tracemalloc
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(best, 6), "peak_bytes": peak}
+
+# 对指定用户规模运行各热点操作
+def run_bench_size(user_count, work_dir):
+    config = generate_bench_config(user_count)
+    config_file = Path(work_dir) / f"config-{user_count}.json"
+    save_json(config_file, config)
+    index = build_user_index(config)
+    users_info = get_users_from_config(config, index)
+    vless_params = get_vless_inbound_params(index["vless"], "203.0.113.1", "bench-public-key")
+    hy2_params = get_hy2_inbound_params(index["hysteria2"], "203.0.113.1")
+    repeat = 5 if user_count <= 1000 else 1
+    
+    def save_config():
+        # 每次写入不同内容，避免save_json因内容相同而跳过
+        config["bench_round"] = config.get("bench_round", 0) + 1
+        save_json(config_file, config)
+    
+    def import_db():
+        conn = open_user_db(Path(work_dir) / f"users-{user_count}-{time.monotonic_ns()}.db", Path(work_dir) / "missing.json")
+        try:
+            import_users_from_config(conn, config)
+            db_query_users(conn, "user0001", limit=LIST_PAGE_SIZE)
+        finally:
+            conn.close()
+    
+    operations = {
+        "load_config": lambda: load_config(config_file),
+        "save_json": save_config,
+        "build_user_index": lambda: build_user_index(config),
+        "get_users_from_config": lambda: get_users_from_config(config),
+        "update_user_urls": lambda: update_user_urls(config, users_info, index),
+        "generate_vless_url": lambda: [generate_vless_url(dict(vless_params, uuid=info["uuid"]), name)
+                                       for name, info in users_info.items()],
+        "generate_hysteria2_url": lambda: [generate_hysteria2_url(dict(hy2_params, password=info["hy2_password"]), name)
+                                           for name, info in users_info.items()],
+        "import_users_db": import_db,
+    }
+    
+    results = {}
+    for name, func in operations.items():
+        results[name] = measure_operation(func, repeat)
+        print(f"  {name:<24} {results[name]['seconds'] * 1000:>10.2f} ms  峰值内存 {format_bytes(results[name]['peak_bytes'])}")
+    
+    # 二维码只取少量样本，在当前进程中直接渲染 (不经过缓存和进程池)，结果为单张耗时
+    if importlib.util.find_spec("qrcode") and importlib.util.find_spec("PIL"):
+        sample = [info["vless_url"] for info in list(users_info.values())[:BENCH_QRCODE_SAMPLE]]
+        qrcode_dir = Path(work_dir) / f"qrcode-{user_count}"
+        qrcode_dir.mkdir(exist_ok=True)
+        
+        def render_sample():
+            for i, url in enumerate(sample):
+                render_qrcode_image(url, qrcode_dir / f"{i}.png")
+        
+        result = measure_operation(render_sample, repeat)
+        result["seconds"] = round(result["seconds"] / max(len(sample), 1), 6)
+        results["render_qrcode_image"] = result
+        print(f"  {'render_qrcode_image':<24} {result['seconds'] * 1000:>10.2f} ms  (单张，共{len(sample)}张)")
+    return results
+
+# 与基线比较，返回变慢的操作列表
+def compare_bench_results(results, baseline):
+    regressions = []
+    for size, operations in results.items():
+        for name, result in operations.items():
+            base = baseline.get(size, {}).get(name)
+            if not base or not base.get("seconds"):
+                continue
+            ratio = result["seconds"] / base["seconds"]
+            if ratio > BENCH_REGRESSION_THRESHOLD:
+                regressions.append((size, name, ratio))
+    return regressions
+
+# 运行基准测试并写入JSON结果，指定基线时报告性能回退
+def run_benchmarks(sizes=BENCH_SIZES, output_file=BENCH_BASELINE_FILE, baseline_file=None):
+    baseline = None
+    if baseline_file:
+        try:
+            with open(baseline_file, 'r') as f:
+                baseline = json.load(f).get("results", {})
+        except (OSError, ValueError) as e:
+            print(f"读取基线失败: {e}")
+            return False
+    
+    results = {}
+    with BenchStubs(), tempfile.TemporaryDirectory(prefix="sing-box-bench-") as work_dir:
+        for size in sizes:
+            print(f"\n=== {size} 个用户 ===")
+            results[str(size)] = run_bench_size(size, work_dir)
+    
+    save_json(Path(output_file), {
+        "created_at": int(time.time()),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "results": results
+    })
+    print(f"\n结果已写入 {output_file}")
+    
+    if baseline is None:
+        return True
+    regressions = compare_bench_results(results, baseline)
+    for size, name, ratio in regressions:
+        print(f"性能回退: {size} 个用户 {name} 耗时为基线的 {ratio:.2f} 倍")
+    if not regressions:
+        print("与基线相比没有性能回退")
+    return not regressions
+
+# 本机执行器 (指定root时文件路径映射到该目录下，命令通过chroot在该目录中执行，
+# 因此远程脚本使用的 /etc/sing-box 等绝对路径也都位于该目录中，不会修改本机)
+class LocalExecutor:
+    def __init__(self, root=None):
+        self.root = Path(root) if root else None
+        self.name = f"local:{self.root}" if self.root else "local"
+    
+    # 将绝对路径映射到执行器的根目录下
+    def resolve(self, path):
+        return str(self.root / str(path).lstrip("/")) if self.root else str(path)
+    
+    def run(self, cmd, input=None, timeout=FLEET_COMMAND_TIMEOUT):
+        if self.root:
+            cmd = ["chroot", str(self.root)] + list(cmd)
+        return subprocess.run(cmd, input=input, capture_output=True, timeout=timeout)
+    
+    def read_bytes(self, path):
+        return Path(self.resolve(path)).read_bytes()
+    
+    def write_bytes(self, path, data, mode=0o644):
+        target = Path(self.resolve(path))
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = target.with_name(f".{target.name}.tmp")
+        tmp_file.write_bytes(data)
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, target)
+
+# SSH执行器: 通过ControlMaster复用同一主机的连接，多次调用只需一次握手
+class SSHExecutor:
+    def __init__(self, host):
+        self.name = host
+        self.host, _, port = host.rpartition(":") if host.count(":") == 1 else (host, "", "")
+        self.port = port
+    
+    def ssh_command(self, remote_command):
+        # 连接复用的socket目录只能由当前用户访问
+        FLEET_CONTROL_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = os.lstat(FLEET_CONTROL_DIR)
+        if FLEET_CONTROL_DIR.is_symlink() or st.st_uid != os.geteuid() or st.st_mode & 0o077:
+            raise OSError(f"{FLEET_CONTROL_DIR} 的所有者或权限不安全")
+        cmd = ["ssh", "-o", "BatchMode=yes", "-o", "ControlMaster=auto",
+               "-o", f"ControlPath={FLEET_CONTROL_DIR}/%C", "-o", f"ControlPersist={FLEET_CONTROL_PERSIST}"]
+        if self.port:
+            cmd += ["-p", self.port]
+        return cmd + [self.host, "--", remote_command]
+    
+    def run(self, cmd, input=None, timeout=FLEET_COMMAND_TIMEOUT):
+        remote_command = " ".join(shlex.quote(str(arg)) for arg in cmd)
+        return subprocess.run(self.ssh_command(remote_command), input=input, capture_output=True, timeout=timeout)
+    
+    def read_bytes(self, path):
+        result = self.run(["cat", path])
+        if result.returncode != 0:
+            raise OSError(f"{self.name}: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout
+    
+    def write_bytes(self, path, data, mode=0o644):
+        path = str(path)
+        tmp_path = shlex.quote(f"{path}.tmp")
+        script = (f"mkdir -p {shlex.quote(os.path.dirname(path))} && cat > {tmp_path} && "
+                  f"chmod {mode:o} {tmp_path} && mv {tmp_path} {shlex.quote(path)}")
+        result = self.run(["sh", "-c", script], input=data)
+        if result.returncode != 0:
+            raise OSError(f"{self.name}: {result.stderr.decode(errors='replace').strip()}")
+
+# 根据主机描述创建执行器: local、本地目录 (chroot到该目录) 或 [用户@]主机[:端口]
+def make_executor(spec):
+    if spec == "local":
+        return LocalExecutor()
+    if spec.startswith(("/", "./")):
+        return LocalExecutor(spec)
+    return SSHExecutor(spec)
+
+# 读取主机列表
+def load_fleet_hosts():
+    try:
+        with open(FLEET_FILE, 'r') as f:
+            return [host for host in json.load(f).get("hosts", []) if host]
+    except (OSError, ValueError):
+        return []
+
+# 在多台主机上并发执行func(执行器)，返回按主机顺序排列的结果
+# 每项结果: {"host", "ok", "exit_code", "seconds", "output", "error"}
+def run_on_fleet(hosts, func, max_workers=FLEET_MAX_WORKERS):
+    def run_host(host):
+        executor = make_executor(host)
+        start = time.monotonic()
+        result = {"host": host, "ok": False, "exit_code": None, "output": "", "error": None}
+        try:
+            completed = func(executor)
+            result["exit_code"] = completed.returncode
+            result["ok"] = completed.returncode == 0
+            result["output"] = (completed.stdout or b"").decode(errors="replace")
+            if not result["ok"]:
+                result["error"] = (completed.stderr or b"").decode(errors="replace").strip()
+        except (OSError, subprocess.SubprocessError) as e:
+            result["error"] = str(e)
+        result["seconds"] = time.monotonic() - start
+        return result
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(hosts)))) as pool:
+        return list(pool.map(run_host, hosts))
+
+# 在所有主机上执行本工具的子命令 (push为True时先上传当前脚本)，或直接执行shell命令
+def run_fleet_command(command, hosts=None, max_workers=FLEET_MAX_WORKERS, push=False, shell=False):
+    hosts = hosts or load_fleet_hosts()
+    if not hosts:
+        print(f"没有可用的主机，请在 {FLEET_FILE} 中配置 hosts 或使用 --hosts 指定")
+        return False
+    if not command:
+        print("请指定要执行的命令")
+        return False
+    script = Path(os.path.abspath(__file__)).read_bytes() if push else None
+    
+    def execute(executor):
+        if shell:
+            return executor.run(["sh", "-c", " ".join(command)])
+        if script is not None:
+            executor.write_bytes(FLEET_REMOTE_SCRIPT, script, 0o755)
+        return executor.run(["python3", FLEET_REMOTE_SCRIPT] + list(command))
+    
+    start = time.monotonic()
+    results = run_on_fleet(hosts, execute, max_workers)
+    
+    for result in results:
+        status = "成功" if result["ok"] else "失败"
+        print(f"\n=== {result['host']}: {status} (退出码 {result['exit_code']}, 耗时 {result['seconds'] * 1000:.0f} ms) ===")
+        if result["output"].strip():
+            print(result["output"].rstrip())
+        if result["error"]:
+            print(f"错误: {result['error']}")
+    
+    failed = [result["host"] for result in results if not result["ok"]]
+    print(f"\n共 {len(results)} 台主机，成功 {len(results) - len(failed)} 台，"
+          f"失败 {len(failed)} 台，总耗时 {(time.monotonic() - start) * 1000:.0f} ms")
+    if failed:
+        print("失败的主机: " + ", ".join(failed))
+    return not failed
+
+# 操作跟踪记录 (启用跟踪后由各包装函数追加)
+_trace_state = {"enabled": False, "events": [], "start": 0.0, "file": None}
+
+# 记录一次操作
+def record_trace_event(category, name, start, duration, exit_code=None, size=None, detail=None):
+    _trace_state["events"].append({
+        "category": category, "name": name, "start": start, "duration": duration,
+        "exit_code": exit_code, "bytes": size, "detail": detail, "tid": threading.get_ident()
+    })
+
+# 统计读写字节数的文件对象包装，关闭时记录一次file事件
+class TracedFile:
+    def __init__(self, f, path, mode):
+        self._file = f
+        self._path = str(path)
+        self._mode = mode
+        self._start = time.perf_counter()
+        self._bytes = 0
+        self._recorded = False
+    
+    def read(self, *args):
+        data = self._file.read(*args)
+        self._bytes += len(data)
+        return data
+    
+    def readline(self, *args):
+        line = self._file.readline(*args)
+        self._bytes += len(line)
+        return line
+    
+    def write(self, data):
+        self._bytes += len(data)
+        return self._file.write(data)
+    
+    def __iter__(self):
+        for line in self._file:
+            self._bytes += len(line)
+            yield line
+    
+    def close(self):
+        self._file.close()
+        if not self._recorded:
+            self._recorded = True
+            name = "write" if any(flag in self._mode for flag in "wax+") else "read"
+            record_trace_event("file", name, self._start, time.perf_counter() - self._start,
+                               size=self._bytes, detail=self._path)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        return False
+    
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+def traced_open(file, mode='r', *args, **kwargs):
+    f = builtins.open(file, mode, *args, **kwargs)
+    return TracedFile(f, file, mode) if isinstance(file, (str, bytes, os.PathLike)) else f
+
+# 包装subprocess.run: 记录命令、耗时、退出码和输出字节数
+def make_traced_run(run):
+    @functools.wraps(run)
+    def traced_run(cmd, *args, **kwargs):
+        argv = cmd.split() if isinstance(cmd, str) else [str(arg) for arg in cmd]
+        name = " ".join(argv[:2]) if argv and argv[0] in ("systemctl", "ufw", "apt", "yum") else (argv[0] if argv else "")
+        start = time.perf_counter()
+        exit_code = None
+        size = None
+        try:
+            result = run(cmd, *args, **kwargs)
+            exit_code = result.returncode
+            size = sum(len(out) for out in (result.stdout, result.stderr) if out)
+            return result
+        except subprocess.CalledProcessError as e:
+            exit_code = e.returncode
+            raise
+        finally:
+            record_trace_event("subprocess", os.path.basename(name), start, time.perf_counter() - start,
+                               exit_code, size, " ".join(argv))
+    return traced_run
+
+# 包装模块函数
+def make_traced_function(func, category):
+    @functools.wraps(func)
+    def traced(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            detail = str(args[0]) if args else None
+            size = None
+            if category == "file" and args:
+                try:
+                    size = os.path.getsize(args[0])
+                except OSError:
+                    pass
+            record_trace_event(category, func.__name__, start, time.perf_counter() - start, size=size, detail=detail)
+    return traced
+
+# 启用操作跟踪，退出时输出汇总 (指定trace_file时同时写入Chrome trace JSON)
+def enable_tracing(trace_file=None):
+    if _trace_state["enabled"]:
+        return
+    _trace_state.update(enabled=True, start=time.perf_counter(), file=trace_file)
+    
+    module = globals()
+    subprocess.run = make_traced_run(subprocess.run)
+    module["open"] = traced_open
+    for name, category in TRACED_FUNCTIONS.items():
+        module[name] = make_traced_function(module[name], category)
+    atexit.register(finish_tracing)
+
+# 按操作汇总跟踪记录
+def summarize_trace_events(events):
+    summary = {}
+    for event in events:
+        item = summary.setdefault((event["category"], event["name"]),
+                                  {"count": 0, "total": 0.0, "max": 0.0, "bytes": 0, "failed": 0})
+        item["count"] += 1
+        item["total"] += event["duration"]
+        item["max"] = max(item["max"], event["duration"])
+        item["bytes"] += event["bytes"] or 0
+        if event["exit_code"]:
+            item["failed"] += 1
+    return sorted(summary.items(), key=lambda kv: kv[1]["total"], reverse=True)
+
+# 生成Chrome trace-event格式 (chrome://tracing 或 Perfetto 可直接打开)
+def build_chrome_trace(events, origin):
+    trace_events = []
+    for event in events:
+        trace_events.append({
+            "name": event["name"],
+            "cat": event["category"],
+            "ph": "X",
+            "ts": round((event["start"] - origin) * 1e6, 1),
+            "dur": round(event["duration"] * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": event["tid"],
+            "args": {key: event[key] for key in ("detail", "exit_code", "bytes") if event[key] is not None}
+        })
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+# 输出跟踪汇总
+def finish_tracing():
+    events = _trace_state["events"]
+    elapsed = time.perf_counter() - _trace_state["start"]
+    print(f"\n=== 操作跟踪 (总耗时 {elapsed * 1000:.0f} ms, {len(events)} 次操作) ===", file=sys.stderr)
+    print(f"{'类别':<10} {'操作':<24} {'次数':>6} {'总耗时ms':>10} {'最长ms':>9} {'字节':>10} {'失败':>5}", file=sys.stderr)
+    for (category, name), item in summarize_trace_events(events):
+        print(f"{category:<10} {name:<24} {item['count']:>6} {item['total'] * 1000:>10.1f} "
+              f"{item['max'] * 1000:>9.1f} {format_bytes(item['bytes']):>10} {item['failed']:>5}", file=sys.stderr)
+    
+    trace_file = _trace_state["file"]
+    if trace_file:
+        try:
+            with builtins.open(trace_file, 'w') as f:
+                json.dump(build_chrome_trace(events, _trace_state["start"]), f)
+            print(f"Chrome trace已写入 {trace_file}", file=sys.stderr)
+        except OSError as e:
+            print(f"写入trace文件失败: {e}", file=sys.stderr)
+
+# 解析命令行参数
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="sing-box 安装配置工具")
+    parser.add_argument("--trace", action="store_true", help=f"跟踪子进程、文件和网络操作并在退出时输出汇总 (也可设置{TRACE_ENV})")
+    parser.add_argument("--trace-file", help="同时写入Chrome trace-event JSON文件")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    import_parser = subparsers.add_parser("import", help="批量导入用户 (CSV或JSONL)")
+    import_parser.add_argument("file", help="用户文件路径")
+    import_parser.add_argument("-o", "--output", help="链接输出文件 (默认输出到终端)")
+    
+    export_parser = subparsers.add_parser("export", help="导出所有用户链接")
+    export_parser.add_argument("-f", "--format", choices=["plain", "base64", "json"], default="plain", help="输出格式")
+    export_parser.add_argument("-o", "--output", help="输出文件 (默认输出到终端)")
+    
+    subparsers.add_parser("deps", help="重新检查并安装依赖")
+    subparsers.add_parser("firewall", help="按配置同步防火墙端口")
+    
+    list_parser = subparsers.add_parser("list", help="分页列出用户链接")
+    list_parser.add_argument("-f", "--filter", help="按用户名或节点名称过滤")
+    list_parser.add_argument("-r", "--regex", action="store_true", help="过滤条件使用正则表达式")
+    list_parser.add_argument("-s", "--sort", choices=["config", "name", "node"], default="config", help="排序方式")
+    list_parser.add_argument("-p", "--page", type=int, default=1, help="页码")
+    list_parser.add_argument("-n", "--page-size", type=int, default=LIST_PAGE_SIZE, help="每页数量")
+    
+    stats_parser = subparsers.add_parser("stats", help="用户流量统计")
+    stats_subparsers = stats_parser.add_subparsers(dest="stats_command")
+    stats_subparsers.add_parser("enable", help="在配置中启用流量统计接口")
+    collect_parser = stats_subparsers.add_parser("collect", help="采集流量数据")
+    collect_parser.add_argument("--interval", type=int, default=60, help="采集间隔 (秒)")
+    collect_parser.add_argument("--once", action="store_true", help="只采集一次")
+    top_parser = stats_subparsers.add_parser("top", help="流量排行")
+    top_parser.add_argument("-w", "--window", default="1h", help="时间窗口，如 1h、1d")
+    top_parser.add_argument("-n", "--limit", type=int, default=10, help="显示数量")
+    
+    shards_parser = subparsers.add_parser("shards", help="查看或设置sing-box分片数量")
+    shards_parser.add_argument("count", type=int, nargs="?", help="分片数量 (1表示不分片)")
+    
+    tune_parser = subparsers.add_parser("tune", help="内核网络参数调优 (BBR、UDP缓冲区)")
+    tune_parser.add_argument("action", choices=["diff", "apply", "verify", "rollback"], help="操作")
+    tune_parser.add_argument("-p", "--profile", choices=sorted(SYSCTL_PROFILES), default="default", help="调优方案")
+    tune_parser.add_argument("--root", help="在指定根目录下操作 (用于测试)")
+    
+    bandwidth_parser = subparsers.add_parser("bandwidth", help="按网卡速率或档位调整Hysteria2带宽")
+    bandwidth_parser.add_argument("-t", "--tier", choices=sorted(HY2_BANDWIDTH_TIERS), help="使用命名档位")
+    bandwidth_parser.add_argument("--up", type=int, help="上行带宽 (Mbps)")
+    bandwidth_parser.add_argument("--down", type=int, help="下行带宽 (Mbps)")
+    bandwidth_parser.add_argument("--egress", type=int, help=f"设置出口限速 (Mbps)，保存到{BANDWIDTH_FILE}")
+    bandwidth_parser.add_argument("--ingress", type=int, help="设置入口限速 (Mbps)")
+    bandwidth_parser.add_argument("-n", "--dry-run", action="store_true", help="只显示调整结果，不修改配置")
+    
+    cert_parser = subparsers.add_parser("cert", help="查看或轮换自签证书")
+    cert_parser.add_argument("--rotate", action="store_true", help="证书即将过期或密钥类型不同时重新生成并重载")
+    cert_parser.add_argument("--force", action="store_true", help="与--rotate一起使用，总是重新生成")
+    cert_parser.add_argument("-k", "--key-type", choices=CERT_KEY_TYPES, default=CERT_KEY_TYPE, help="密钥类型")
+    cert_parser.add_argument("-d", "--domain", help="证书域名 (默认使用Hysteria2入站的server_name)")
+    
+    health_parser = subparsers.add_parser("health", help="并发检查所有入站端口")
+    health_parser.add_argument("--host", default="127.0.0.1", help="检查的地址")
+    health_parser.add_argument("-c", "--count", type=int, default=1, help="每个端口的探测次数")
+    health_parser.add_argument("-t", "--timeout", type=float, default=HEALTH_TIMEOUT, help="超时 (秒)")
+    health_parser.add_argument("-w", "--watch", type=float, default=0, help="每隔指定秒数重复检查")
+    
+    fleet_parser = subparsers.add_parser("fleet", help="在多台服务器上并发执行命令")
+    fleet_parser.add_argument("-H", "--hosts", help=f"主机列表，逗号分隔 (默认读取{FLEET_FILE})")
+    fleet_parser.add_argument("-j", "--jobs", type=int, default=FLEET_MAX_WORKERS, help="并发数")
+    fleet_parser.add_argument("--push", action="store_true", help="执行前上传当前脚本")
+    fleet_parser.add_argument("--shell", action="store_true", help="执行shell命令而不是本工具的子命令")
+    fleet_parser.add_argument("remote_args", nargs=argparse.REMAINDER, help="要执行的命令 (放在 -- 之后)")
+    
+    logs_parser = subparsers.add_parser("logs", help="增量分析sing-box日志")
+    logs_parser.add_argument("-w", "--window", default="1d", help="时间窗口，如 1h、1d")
+    logs_parser.add_argument("-n", "--limit", type=int, default=10, help="显示用户数量")
+    logs_parser.add_argument("-u", "--user", help="只显示指定用户")
+    logs_parser.add_argument("--reset", action="store_true", help="丢弃游标和已汇总的统计后重新读取")
+    
+    bench_parser = subparsers.add_parser("bench", help="运行性能基准测试")
+    bench_parser.add_argument("--sizes", default=",".join(map(str, BENCH_SIZES)), help="用户规模，逗号分隔")
+    bench_parser.add_argument("-o", "--output", default=str(BENCH_BASELINE_FILE), help="结果输出文件")
+    bench_parser.add_argument("--baseline", help="用于比较的基线文件")
+    
+    serve_parser = subparsers.add_parser("serve", help="启动订阅服务")
+    serve_parser.add_argument("--host", default=SUBSCRIPTION_HOST, help="监听地址")
+    serve_parser.add_argument("--port", type=int, default=SUBSCRIPTION_PORT, help="监听端口")
+    
+    return parser.parse_args(argv)
+
+# 执行命令行子命令
+def run_command(args):
+    if args.command == "import":
+        return bulk_add_users(args.file, args.output)
+    if args.command == "export":
+        return export_user_links(args.output, args.format)
+    if args.command == "deps":
+        return check_dependencies(force=True)
+    if args.command == "list":
+        return list_users(args.filter, args.regex, args.sort, args.page, max(args.page_size, 1), interactive=False)
+    if args.command == "stats":
+        if args.stats_command == "enable":
+            return enable_traffic_stats()
+        if args.stats_command == "collect":
+            return run_traffic_collector(args.interval, args.once)
+        if args.stats_command == "top":
+            return print_traffic_top(args.window, args.limit)
+        print("请指定 enable、collect 或 top")
+        return False
+    if args.command == "shards":
+        return set_shard_count(args.count) if args.count is not None else show_shards()
+    if args.command == "tune":
+        if args.action == "diff":
+            diff_sysctl_profile(args.profile, args.root)
+            return True
+        if args.action == "apply":
+            return apply_sysctl_profile(args.profile, args.root)
+        if args.action == "verify":
+            return verify_sysctl_profile(args.profile, args.root)
+        return rollback_sysctl_profile(args.root)
+    if args.command == "bandwidth":
+        if args.egress is not None or args.ingress is not None:
+            egress, ingress = load_bandwidth_limits()
+            save_json(BANDWIDTH_FILE, {"egress_mbps": args.egress if args.egress is not None else egress,
+                                       "ingress_mbps": args.ingress if args.ingress is not None else ingress})
+        return tune_hy2_bandwidth(args.tier, args.up, args.down, args.dry_run)
+    if args.command == "cert":
+        if args.rotate:
+            return rotate_certificate(args.key_type, args.domain, args.force)
+        return show_certificate_info()
+    if args.command == "health":
+        return run_health_check(args.host, max(args.count, 1), args.timeout, args.watch)
+    if args.command == "fleet":
+        hosts = [host.strip() for host in args.hosts.split(",") if host.strip()] if args.hosts else None
+        remote_args = args.remote_args[1:] if args.remote_args[:1] == ["--"] else args.remote_args
+        return run_fleet_command(remote_args, hosts, args.jobs, args.push, args.shell)
+    if args.command == "logs":
+        return analyze_singbox_logs(args.window, args.limit, args.user, args.reset)
+    if args.command == "bench":
+        try:
+            sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+        except ValueError:
+            print("无效的用户规模")
+            return False
+        return run_benchmarks(sizes, args.output, args.baseline)
+    if args.command == "serve":
+        return run_subscription_server(args.host, args.port)
+    if args.command == "firewall":
+        config = load_config()
+        return reconcile_firewall(config) if config else False
+    return False
+
 # 主函数
 def main():
-    if os.geteuid() != 0:
+    args = parse_args()
+    
+    trace_env = os.environ.get(TRACE_ENV, "")
+    if args.trace or args.trace_file or trace_env not in ("", "0"):
+        enable_tracing(args.trace_file or (trace_env if trace_env not in ("", "0", "1") else None))
+    
+    # 基准测试不修改系统，多服务器命令在远程执行，均无需root权限
+    if os.geteuid() != 0 and args.command not in ("bench", "fleet"):
         print("此脚本需要root权限运行")
         sys.exit(1)
+    
+    if args.command:
+        sys.exit(0 if run_command(args) else 1)
         
     try:
         if not check_dependencies():
             sys.exit(1)
+        
+        # 证书到期检查只在启动时进行一次
+        cert_expiring = certificate_expiring()
             
         while True:
-            os.system('clear' if os.name == 'posix' else 'cls')
+            if os.name == 'posix':
+                print("\033[H\033[2J", end="")
+            else:
+                os.system('cls')
             print("\n=== sing-box 安装配置工具 ===")
             
             installed, version = check_singbox()
@@ -1340,14 +4342,17 @@ def main():
                 print(f"当前sing-box版本: {version}")
             else:
                 print("sing-box未安装")
+            if cert_expiring:
+                print("警告: Hysteria2证书即将过期，请运行 cert --rotate 更新")
                 
             print("1. sing-box 管理")
             print("2. 配置 sing-box")
             print("3. 用户管理")
             print("4. 防火墙管理")
+            print("5. 服务器IP设置")
             print("0. 退出")
             
-            choice = input("\n请选择操作 [0-4]: ").strip()
+            choice = input("\n请选择操作 [0-5]: ").strip()
             
             if choice == "1":
                 manage_singbox()
@@ -1357,6 +4362,8 @@ def main():
                 manage_users()
             elif choice == "4":
                 manage_firewall()
+            elif choice == "5":
+                set_server_ip()
             elif choice == "0":
                 print("感谢使用，再见！")
                 break